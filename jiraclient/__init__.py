@@ -2,3 +2,4 @@ __author__ = "Matthew Callaway <mcallawa@genome.wustl.edu>"
 __license__ = "GPL License"
 __version__ = "2.1.10"
 from jiraclient import Jiraclient
+from asyncclient import AsyncJiraclient
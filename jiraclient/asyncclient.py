@@ -0,0 +1,162 @@
+#
+# asyncclient.py
+#
+# Run many Jiraclient operations at once without blocking the caller.
+#
+# Each operation returns a Future straight away.  The requests are made on a
+# pool of threads sharing the Jiraclient's session and keep-alive connections,
+# and the Jiraclient's request limiter keeps Jira from being swamped however
+# many operations are outstanding.  One thread can start hundreds of
+# operations and collect the results as they complete:
+#
+#   client = AsyncJiraclient(jira)
+#   futures = [ client.add_comment(key,"Deployed") for key in keys ]
+#   for future in as_completed(futures):
+#     future.result()
+#
+
+import copy
+import threading
+import Queue
+
+class JiraError(Exception):
+  # An operation failed, with the message Jiraclient.fatal() logged
+  pass
+
+class Future(object):
+  # The result of an operation that may not have finished yet
+  def __init__(self):
+    self.event = threading.Event()
+    self.lock = threading.Lock()
+    self.callbacks = []
+    self.value = None
+    self.error = None
+
+  def done(self):
+    return self.event.isSet()
+
+  def wait(self,timeout=None):
+    self.event.wait(timeout)
+    return self.done()
+
+  def result(self,timeout=None):
+    # The operation's return value, raising what it raised
+    if not self.wait(timeout):
+      raise JiraError("Timed out")
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+  def exception(self,timeout=None):
+    if not self.wait(timeout):
+      raise JiraError("Timed out")
+    return self.error
+
+  def add_done_callback(self,func):
+    # func(future) is called once the operation is done, at once if it is
+    self.lock.acquire()
+    try:
+      if not self.done():
+        self.callbacks.append(func)
+        return
+    finally:
+      self.lock.release()
+    func(self)
+
+  def finish(self,value=None,error=None):
+    self.lock.acquire()
+    try:
+      (self.value,self.error) = (value,error)
+      self.event.set()
+      callbacks = self.callbacks
+      self.callbacks = []
+    finally:
+      self.lock.release()
+    for func in callbacks:
+      func(self)
+
+def as_completed(futures):
+  # Yield futures as they finish, whatever order they were started in
+  done = Queue.Queue()
+  futures = list(futures)
+  for future in futures:
+    future.add_done_callback(done.put)
+  for n in range(len(futures)):
+    # A timeout lets KeyboardInterrupt through
+    yield done.get(True,86400)
+
+def gather(futures):
+  # The results of futures, in order, raising the first failure
+  return [ future.result() for future in futures ]
+
+class AsyncJiraclient(object):
+  # Jiraclient methods that can be run here, each returns a Future
+  operations = (
+    'call_api',
+    'get_issue', 'fetch_issue', 'get_worklogs', 'get_issue_links',
+    'get_project_id', 'get_issue_types', 'get_customfields',
+    'get_resolutions', 'get_transitions', 'get_project_versions',
+    'get_project_components', 'get_priorities', 'get_serverinfo',
+    'create_issue', 'create_issues', 'modify_issue', 'delete_issue',
+    'resolve_issue', 'add_comment', 'log_work',
+    'link_issues', 'unlink_issues', 'subtask_link', 'epic_link',
+  )
+
+  def __init__(self,client,workers=None):
+    # client is a Jiraclient that has been set up, ie. authenticated
+    self.client = client
+    if workers is None:
+      workers = client.get_int_option('max_connections',client.max_connections)
+    from multiprocessing.pool import ThreadPool
+    self.pool = ThreadPool(max(workers,1))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*exc_info):
+    self.close()
+
+  def close(self):
+    # Wait for outstanding operations, then stop the threads
+    self.pool.close()
+    self.pool.join()
+
+  def spawn(self,options):
+    # A Jiraclient for one operation that needs its own options, eg.
+    # log_work() reads the worklog from options.
+    values = copy.deepcopy(self.client.options)
+    for (k,v) in options.items():
+      setattr(values,k,v)
+    return self.client.spawn(values)
+
+  def submit(self,func,*args,**kwargs):
+    # Run func(*args,**kwargs) on the pool, returns its Future
+    future = Future()
+    self.pool.apply_async(self.run,(future,func,args,kwargs))
+    return future
+
+  def run(self,future,func,args,kwargs):
+    try:
+      value = func(*args,**kwargs)
+    except SystemExit, details:
+      # Jiraclient.fatal() exits, report its message instead
+      future.finish(error=JiraError(getattr(details,'msg',None) or "Failed"))
+    except Exception, details:
+      future.finish(error=details)
+    else:
+      future.finish(value)
+
+  def __getattr__(self,name):
+    # eg. self.add_comment(key,text) returns a Future for
+    # Jiraclient.add_comment(key,text).  Pass options={...} to run it with
+    # those options changed.
+    if name not in self.operations:
+      raise AttributeError(name)
+    def operation(*args,**kwargs):
+      options = kwargs.pop('options',None)
+      client = self.client
+      if options:
+        client = self.spawn(options)
+      return self.submit(getattr(client,name),*args,**kwargs)
+    operation.__name__ = name
+    return operation
@@ -19,25 +19,30 @@
 # jiraclient.py.  If not, write to the Free Software Foundation, Inc., 59
 # Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import copy
 import getpass
 import os
 import pprint
 import re
 import sys
-import logging, inspect, logging.handlers
+import logging
 import stat
 from optparse import OptionParser
 import ConfigParser
 import json
-import base64
-import datetime
 import itertools
-from restkit import Resource
-from restkit.errors import Unauthorized
+import random
+import time
+import collections
+import threading
+import StringIO
+# Slower imports, eg. restkit, are done where they're needed, so that
+# commands that don't need them, like --version, start quickly.
 
 pp = pprint.PrettyPrinter(indent=4)
 time_rx = re.compile('^\d+[mhdw]$')
 session_rx = re.compile("session timed out")
+issue_key_rx = re.compile('^[A-Za-z][A-Za-z0-9_]*-\d+$')
 
 def time_is_valid(value):
   m = time_rx.search(value)
@@ -45,92 +50,632 @@ def time_is_valid(value):
     return False
   return True
 
+def unicode_to_str(data):
+  # json gives us unicode, but self.maps holds str values
+  if isinstance(data,unicode):
+    return data.encode('utf-8')
+  if isinstance(data,dict):
+    return dict([ (unicode_to_str(k),unicode_to_str(v)) for (k,v) in data.items() ])
+  if isinstance(data,list):
+    return [ unicode_to_str(v) for v in data ]
+  return data
+
+class JSONStream(object):
+  # Decode a JSON document a piece at a time as it's read from a file, so
+  # that a large response needn't be held in memory all at once.
+  whitespace = ' \t\n\r'
+
+  def __init__(self,stream,chunksize=65536):
+    self.stream = stream
+    self.chunksize = chunksize
+    self.decoder = json.JSONDecoder()
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self):
+    # Read more input, dropping what we've decoded.  Read at least as much
+    # as is buffered, so a value larger than chunksize isn't decoded over
+    # and over again.  Returns False at end of input.
+    if self.eof: return False
+    data = self.stream.read(max(self.chunksize,len(self.buf)-self.pos))
+    if not data:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def peek(self):
+    # The next character that isn't whitespace, '' at end of input
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in self.whitespace:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.fill():
+        return ''
+
+  def expect(self,char):
+    if self.peek() != char:
+      raise ValueError("Expected %r at %r" % (char,self.buf[self.pos:self.pos+20]))
+    self.pos += 1
+
+  def value(self):
+    # Decode the next whole value
+    self.peek()
+    while True:
+      try:
+        (obj,end) = self.decoder.raw_decode(self.buf,self.pos)
+      except ValueError:
+        if self.fill(): continue
+        raise
+      # A number at the end of the buffer may go on in the next read
+      if end == len(self.buf) and self.fill(): continue
+      self.pos = end
+      return obj
+
+  def items(self,key=None):
+    # Yield the items of an array one by one.  With key, the array is the
+    # value of key in the top level object, eg. 'issues' in a search result,
+    # otherwise the document itself is the array.
+    if key:
+      self.expect('{')
+      while True:
+        if self.peek() == '}':
+          return
+        name = self.value()
+        self.expect(':')
+        if name == key: break
+        self.value()
+        if self.peek() == ',':
+          self.pos += 1
+    self.expect('[')
+    if self.peek() == ']':
+      return
+    while True:
+      yield self.value()
+      if self.peek() == ',':
+        self.pos += 1
+      else:
+        self.expect(']')
+        return
+
+def iter_response_items(response,key=None):
+  # Yield decoded array items from a restkit response as they arrive
+  body = response.body_stream()
+  try:
+    for item in JSONStream(body).items(key):
+      yield item
+  finally:
+    body.close()
+
+class Fatal(SystemExit):
+  # What Jiraclient.fatal() raises.  It exits with status 1 like
+  # sys.exit(1), and carries the message for whoever catches it, eg. the
+  # worker thread of a batch operation.
+  def __init__(self,msg=None):
+    SystemExit.__init__(self,1)
+    self.msg = msg
+
+def fatal_message(details):
+  # The message of a SystemExit caught from fatal()
+  return getattr(details,'msg',None) or "Failed"
+
+class LineParser(OptionParser):
+  # Parses a --batch line, raising ValueError rather than exiting
+  def error(self,msg):
+    raise ValueError(msg)
+
+class ThreadOutput(object):
+  # Stands in for sys.stdout so that what each thread prints can be
+  # collected separately instead of interleaving.
+  def __init__(self,stream):
+    self.stream = stream
+    self.local = threading.local()
+
+  def write(self,data):
+    buf = getattr(self.local,'buffer',None)
+    if buf is None:
+      self.stream.write(data)
+    else:
+      buf.write(data)
+
+  def capture(self):
+    self.local.buffer = StringIO.StringIO()
+
+  def release(self):
+    # Stop capturing, returns what was printed
+    data = self.local.buffer.getvalue()
+    self.local.buffer = None
+    return data
+
+  def __getattr__(self,name):
+    return getattr(self.stream,name)
+
+class MessageStream(object):
+  # A file that sends what is written to it to a daemon client, as JSON
+  # messages like {"out": "text"}.
+  def __init__(self,wfile,name):
+    self.wfile = wfile
+    self.name = name
+
+  def write(self,data):
+    if isinstance(data,str):
+      data = data.decode('utf-8','replace')
+    self.wfile.write(json.dumps({self.name: data}) + "\n")
+
+  def flush(self):
+    self.wfile.flush()
+
+class Limiter(object):
+  # Limits how many API requests are made at once.  The limit halves when
+  # Jira says it's overloaded, and grows back by one after each run of
+  # successful requests, up to maximum.
+  def __init__(self,maximum):
+    self.maximum = max(maximum,1)
+    self.limit = self.maximum
+    self.active = 0
+    self.successes = 0
+    self.cond = threading.Condition()
+
+  def acquire(self):
+    self.cond.acquire()
+    try:
+      while self.active >= self.limit:
+        self.cond.wait()
+      self.active += 1
+    finally:
+      self.cond.release()
+
+  def release(self):
+    self.cond.acquire()
+    try:
+      self.active -= 1
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def succeeded(self):
+    self.cond.acquire()
+    try:
+      self.successes += 1
+      if self.limit < self.maximum and self.successes >= self.limit:
+        self.limit += 1
+        self.successes = 0
+        self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def overloaded(self):
+    self.cond.acquire()
+    try:
+      self.limit = max(self.limit // 2,1)
+      self.successes = 0
+    finally:
+      self.cond.release()
+
+class RequestStats(object):
+  # Counts, latencies, bytes, retries and errors of API requests, by method
+  # and endpoint, eg. "get rest/api/latest/issue/{key}".
+  buckets = (0.05,0.1,0.25,0.5,1,2.5,5,10)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.endpoints = {}
+    self.started = time.time()
+
+  def endpoint(self,uri):
+    # The uri, less its query and with keys and ids made into placeholders
+    path = uri.split('?',1)[0]
+    path = re.sub(r'/project/[^/]+','/project/{project}',path)
+    path = re.sub(r'/[A-Za-z][A-Za-z0-9_]*-\d+(?=/|$)','/{key}',path)
+    path = re.sub(r'/\d+(?=/|$)','/{id}',path)
+    return path
+
+  def record(self,method,uri,seconds,sent=0,received=0,error=False,retried=False):
+    name = (method.lower(),self.endpoint(uri))
+    self.lock.acquire()
+    try:
+      stats = self.endpoints.get(name)
+      if stats is None:
+        stats = self.endpoints[name] = {
+          'count': 0, 'errors': 0, 'retries': 0, 'sent': 0, 'received': 0,
+          'seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * len(self.buckets),
+        }
+      stats['count'] += 1
+      stats['errors'] += int(error)
+      stats['retries'] += int(retried)
+      stats['sent'] += sent
+      stats['received'] += received
+      stats['seconds'] += seconds
+      stats['max_seconds'] = max(stats['max_seconds'],seconds)
+      for (n,bound) in enumerate(self.buckets):
+        if seconds <= bound:
+          stats['buckets'][n] += 1
+          break
+    finally:
+      self.lock.release()
+
+  def report(self,format,connections):
+    # The stats as text, json or prometheus, with connection counts
+    self.lock.acquire()
+    try:
+      endpoints = sorted(self.endpoints.items(),key=lambda item: -item[1]['seconds'])
+      return getattr(self,'report_%s' % format)(endpoints,connections)
+    finally:
+      self.lock.release()
+
+  def report_text(self,endpoints,connections):
+    lines = ["Jira requests: %d in %.2fs, %d connections opened, %d reused" % (
+      sum([ stats['count'] for (name,stats) in endpoints ]),time.time() - self.started,
+      connections['connections'],connections['reused'])]
+    lines.append("%6s %6s %7s %8s %8s %8s %8s  %s" % ('count','errors','retries','total s','avg ms','max ms','recv kB','endpoint'))
+    for ((method,path),stats) in endpoints:
+      lines.append("%6d %6d %7d %8.2f %8.1f %8.1f %8.1f  %s %s" % (stats['count'],stats['errors'],stats['retries'],
+        stats['seconds'],stats['seconds'] / stats['count'] * 1000,stats['max_seconds'] * 1000,
+        stats['received'] / 1024.0,method.upper(),path))
+    return "\n".join(lines) + "\n"
+
+  def report_json(self,endpoints,connections):
+    data = {'connections': connections, 'endpoints': []}
+    for ((method,path),stats) in endpoints:
+      stats = dict(stats,method=method,endpoint=path)
+      stats['buckets'] = dict(zip([ str(b) for b in self.buckets ],stats['buckets']))
+      data['endpoints'].append(stats)
+    return json.dumps(data) + "\n"
+
+  def report_prometheus(self,endpoints,connections):
+    # The Prometheus text format, eg. for node exporter's textfile collector
+    lines = []
+    counters = (
+      ('requests_total','count','Jira API requests made'),
+      ('request_errors_total','errors','Jira API requests that failed'),
+      ('request_retries_total','retries','Jira API requests that were retried'),
+      ('request_sent_bytes_total','sent','Bytes sent in Jira API requests'),
+      ('request_received_bytes_total','received','Bytes received in Jira API responses'),
+    )
+    for (metric,key,help) in counters:
+      lines.append("# HELP jiraclient_%s %s" % (metric,help))
+      lines.append("# TYPE jiraclient_%s counter" % metric)
+      for ((method,path),stats) in endpoints:
+        lines.append('jiraclient_%s{method="%s",endpoint="%s"} %d' % (metric,method,path,stats[key]))
+    lines.append("# HELP jiraclient_request_duration_seconds Time taken by Jira API requests")
+    lines.append("# TYPE jiraclient_request_duration_seconds histogram")
+    for ((method,path),stats) in endpoints:
+      labels = 'method="%s",endpoint="%s"' % (method,path)
+      total = 0
+      for (bound,count) in zip(self.buckets,stats['buckets']):
+        total += count
+        lines.append('jiraclient_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels,bound,total))
+      lines.append('jiraclient_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels,stats['count']))
+      lines.append('jiraclient_request_duration_seconds_sum{%s} %f' % (labels,stats['seconds']))
+      lines.append('jiraclient_request_duration_seconds_count{%s} %d' % (labels,stats['count']))
+    for (metric,key,help) in (('opened','connections','Connections opened to Jira'),('reused','reused','Requests that reused a connection')):
+      lines.append("# HELP jiraclient_connections_%s_total %s" % (metric,help))
+      lines.append("# TYPE jiraclient_connections_%s_total counter" % metric)
+      lines.append("jiraclient_connections_%s_total %d" % (metric,connections[key]))
+    return "\n".join(lines) + "\n"
+
 class IndentFormatter(logging.Formatter):
-    def __init__( self, fmt=None, datefmt=None ):
+    # Indent messages by call depth when asked to with --log-indent.
+    # Counting frames is cheap, unlike inspect.stack(), which reads source
+    # files for every frame, but it still isn't free, so skip it by default.
+    def __init__( self, fmt=None, datefmt=None, indent=False ):
         logging.Formatter.__init__(self, fmt, datefmt)
-        self.baseline = len(inspect.stack())
+        self.indent = indent
+        self.baseline = 0
+        if indent:
+            self.baseline = self.depth()
+    def depth( self ):
+        frame = sys._getframe(1)
+        depth = 0
+        while frame is not None:
+            depth += 1
+            frame = frame.f_back
+        return depth
     def format( self, rec ):
-        stack = inspect.stack()
-        rec.indent = ' '*(len(stack)-self.baseline)
-        rec.function = stack[8][3]
+        if self.indent:
+            rec.indent = ' '*max(self.depth()-self.baseline,0)
+        else:
+            rec.indent = ''
         out = logging.Formatter.format(self, rec)
-        del rec.indent; del rec.function
+        del rec.indent
         return out
 
+def copy_field(value):
+  # A copy of an issue field's value that can be changed without changing
+  # the original.  Values are strings, dicts, or lists of either.
+  if type(value) is list:
+    return [ dict(item) if type(item) is dict else item for item in value ]
+  if type(value) is dict:
+    return dict(value)
+  return value
+
 class Issue(object):
+  # The fields of an issue and the empty values they read as until they're
+  # set.  Only fields that have been set are kept, in __dict__, so fields()
+  # is the REST payload as it stands.  Other fields, eg. customfield_10010,
+  # can be set too.  Values read before they're set are copies: set them,
+  # don't change them in place.
+  schema = (
+    ('summary',      ''),
+    ('environment',  ''),
+    ('description',  ''),
+    ('duedate',      ''),
+    ('project',      { 'id': None }),
+    ('issuetype',    { 'id': None }),
+    ('assignee',     { 'name': None }),
+    ('priority',     { 'id': None }),
+    ('parent',       { 'key': None }),
+    ('timetracking', { 'originalEstimate': None }),
+    ('labels',       []),
+    ('versions',     [ { 'id': None } ]),
+    ('fixVersions',  [ { 'id': None } ]),
+    ('components',   [ { 'id': None } ]),
+  )
+  empty = dict(schema)
+
+  def __init__(self,**fields):
+    self.__dict__.update(fields)
+
+  def __getattr__(self,name):
+    # Only called for attributes that haven't been set
+    try:
+      return copy_field(self.empty[name])
+    except KeyError:
+      raise AttributeError(name)
+
+  def copy(self):
+    # A copy whose fields can be changed without changing ours
+    issue = self.__class__()
+    for (k,v) in self.__dict__.items():
+      issue.__dict__[k] = copy_field(v)
+    return issue
 
-  def __init__(self):
-    self.summary      = ''
-    self.environment  = ''
-    self.description  = ''
-    self.duedate      = ''
-    self.project      = { 'id': None }
-    self.issuetype    = { 'id': None }
-    self.assignee     = { 'name': None }
-    self.priority     = { 'id': None }
-    self.parent       = { 'key': None }
-    self.timetracking = { 'originalEstimate': None }
-    self.labels       = []
-    self.versions     = [ { 'id': None } ]
-    self.fixVersions  = [ { 'id': None } ]
-    self.components   = [ { 'id': None } ]
+  def fields(self):
+    # The issue's fields for the REST API, leaving out empty ones
+    return dict([ (k,v) for (k,v) in self.__dict__.items() if v and v != self.empty.get(k) ])
 
   def __repr__(self):
-    text = "%s(" % (self.__class__.__name__)
-    for attr in dir(self):
-      if attr.startswith('_'): continue
-      a = getattr(self,attr)
-      if callable(a): continue
-      text += "%s=%r," % (attr,a)
-    text += ")"
-    return text
+    return "%s(%s)" % (self.__class__.__name__,",".join([ "%s=%r" % item for item in sorted(self.__dict__.items()) ]))
 
 class SearchableDict(dict):
+  # A map of Jira ids to names, eg. '10020' -> 'backlog', that can also find
+  # the id of a name.  Names, and the 'name' of dict values, are indexed
+  # case insensitively as they're added, so find_key() needn't scan.  Dict
+  # values must be complete when added, later changes to them aren't seen.
+  def __init__(self,*args,**kwargs):
+      dict.__init__(self)
+      self.index = {}
+      self.update(*args,**kwargs)
+
+  def __reduce__(self):
+      return (self.__class__,(dict(self),))
+
+  def names(self,value):
+      """return the indexed names of a value"""
+      if isinstance(value,basestring):
+          return (value.lower(),)
+      if isinstance(value,dict) and isinstance(value.get('name'),basestring):
+          return (value['name'].lower(),)
+      return ()
+
+  def unindex(self,key):
+      for name in self.names(self[key]):
+          if self.index.get(name) != key: continue
+          del self.index[name]
+          # Some other key may have the same name
+          for (k,v) in self.iteritems():
+              if k != key and name in self.names(v):
+                  self.index[name] = k
+                  break
+
+  def __setitem__(self,key,value):
+      if key in self:
+          self.unindex(key)
+      dict.__setitem__(self,key,value)
+      for name in self.names(value):
+          self.index.setdefault(name,key)
+
+  def __delitem__(self,key):
+      if key in self:
+          self.unindex(key)
+      dict.__delitem__(self,key)
+
+  def update(self,*args,**kwargs):
+      for (k,v) in dict(*args,**kwargs).iteritems():
+          self[k] = v
+
+  def setdefault(self,key,value=None):
+      if key not in self:
+          self[key] = value
+      return self[key]
+
+  def pop(self,key,*default):
+      if key in self:
+          self.unindex(key)
+      return dict.pop(self,key,*default)
+
+  def popitem(self):
+      (k,v) = dict.popitem(self)
+      self.index = {}
+      for (key,value) in self.iteritems():
+          for name in self.names(value):
+              self.index.setdefault(name,key)
+      return (k,v)
+
+  def clear(self):
+      dict.clear(self)
+      self.index = {}
+
+  def copy(self):
+      return self.__class__(self)
+
   def find_key(self,val):
       """return the key of dictionary dic given the value"""
+      if isinstance(val,basestring):
+          return self.index.get(val.lower())
       for k, v in self.iteritems():
           if v == val:
               return k
-          if isinstance(v,dict):
-              if v['name'] == val:
-                  return k
-      else:
-          return None
+      return None
 
   def find_value(self,key):
       """return the value of dictionary dic given the key"""
       if self.has_key(key): return self[key]
       else: return None
 
+class LRUCache(object):
+  # A thread safe map of up to size items, which forgets the least
+  # recently used item to make room for another.
+  def __init__(self,size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.items = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.items)
+
+  def __contains__(self,key):
+    return key in self.items
+
+  def get(self,key,default=None):
+    self.lock.acquire()
+    try:
+      if key not in self.items:
+        return default
+      value = self.items.pop(key)
+      self.items[key] = value
+      return value
+    finally:
+      self.lock.release()
+
+  def put(self,key,value):
+    self.lock.acquire()
+    try:
+      self.items.pop(key,None)
+      self.items[key] = value
+      while len(self.items) > max(self.size,1):
+        self.items.popitem(last=False)
+    finally:
+      self.lock.release()
+
+class TemplateNode(object):
+  # An issue to be made from a template, and the template issues that
+  # must wait for its key.
+  def __init__(self,issue,children=None):
+    self.issue    = issue
+    self.children = children or []
+    self.key      = None
+
 class Jiraclient(object):
   version = "2.1.10"
+  # Bump when the layout of self.maps changes, to ignore stale cache files.
+  metadata_cache_version = 1
+  # Default lifetime in seconds of cached metadata, see --metadata-ttl.
+  metadata_ttl = 86400
+  # Default number of issues per request to the bulk create API, see --bulk-size.
+  bulk_size = 50
+  # Default number of concurrent API calls, see --workers.
+  workers = 4
+  # Default number of idle keep-alive connections kept per host, see --max-connections.
+  max_connections = 10
+  # Default seconds a pooled connection is kept for reuse, see --idle-timeout.
+  idle_timeout = 300
+  # Default seconds we trust a session without asking Jira, see --session-ttl.
+  session_ttl = 1800
+  # Default page size of searches, see --max-results.
+  max_results = 100
+  # Default times to retry a request Jira was too busy for, see --retries,
+  # and seconds to wait before the first retry, see --retry-backoff.
+  retries = 3
+  retry_backoff = 1.0
+  # HTTP methods that do the same thing however often they're repeated.
+  idempotent = ('get','put','delete','head','options')
+  # Projects whose metadata is kept for when they're used again, and
+  # workflow states whose transitions are.
+  max_projects = 32
+  max_workflow_states = 256
   def __init__(self):
     self.issues_created = []
-    self.proxy   = Resource('', filters=[])
+    # restkit Resources are not thread safe, each thread gets its own,
+    # but they all share one pool of keep-alive connections.
+    self.local   = threading.local()
     self.pool    = None
+    self.limiter = None
+    self.stats   = None
+    self.lock    = threading.Lock()
+    self.connection_stats = {'requests': 0, 'connections': 0}
     self.restapi = None
     self.token   = None
     self.cookie  = None
-    self.maps    = {
-      'project'     : SearchableDict(),
+    # The session file contents, and how long Jira actually kept a session
+    # the last time one expired on us.
+    self.session = None
+    self.observed_lifetime = None
+    self.auth_lock = threading.RLock()
+    # Priorities and resolutions are the same in every project, the maps
+    # of every project share these.
+    self.global_maps = {
       'priority'    : SearchableDict(),
+      'resolutions' : SearchableDict(),
+    }
+    self.maps    = self.empty_maps()
+    # Where self.maps came from: None, 'cache' or 'server'
+    self.maps_source = None
+    # The project self.maps are for, see use_project()
+    self.maps_project = None
+    # (maps,maps_source) of recently used projects, by lower case key
+    self.project_maps = LRUCache(self.max_projects)
+    # Transitions by (project key,issue type id,status id)
+    self.transition_maps = LRUCache(self.max_workflow_states)
+    self.serverinfo = None
+    # Set for Jiraclients made by spawn()
+    self.parent = None
+
+  def empty_maps(self):
+    # Maps of one project, sharing our global maps
+    return {
+      'project'     : SearchableDict(),
+      'priority'    : self.global_maps['priority'],
       'issuetype'   : SearchableDict(),
       'versions'    : SearchableDict(),
       'fixversions' : SearchableDict(),
       'components'  : SearchableDict(),
-      'resolutions' : SearchableDict(),
-      'transitions' : SearchableDict(),
+      'resolutions' : self.global_maps['resolutions'],
       'customfields': SearchableDict()
     }
 
+  def use_project(self,project):
+    # Make self.maps those of project.  The maps of the project we leave
+    # are kept, and used again if we come back to it.
+    key = str(project).lower()
+    if key == self.maps_project: return
+    if self.maps_project is not None:
+      self.keep_maps()
+    entry = self.project_maps.get(key)
+    if entry is not None:
+      (self.maps,self.maps_source) = entry
+    elif self.maps_project is not None:
+      (self.maps,self.maps_source) = (self.empty_maps(),None)
+    # Otherwise this is our first project, and the maps we have are its
+    self.maps_project = key
+
+  def keep_maps(self):
+    # Remember self.maps for their project, also if the get_*() methods
+    # have only filled some of them
+    if self.maps_project is not None:
+      self.project_maps.put(self.maps_project,(self.maps,self.maps_source))
+
   def fatal(self,msg=None):
     self.logger.fatal(msg)
-    sys.exit(1)
+    raise Fatal(msg)
 
   def print_version(self):
     print "jiraclient version %s" % self.version
 
-  def parse_args(self):
+  def make_parser(self,parser_class=OptionParser):
     usage = """%prog [options]
 
  Sample Usage:
@@ -147,7 +692,7 @@ class Jiraclient(object):
    and assign it to myself:
    jiraclient.py -u 'username' -p 'jirapassword' -A 'username' -P INFOSYS -Q major -F 10000  -C 10003 -T epic -S 'Investigate Platform IFS'
 """
-    optParser = OptionParser(usage)
+    optParser = parser_class(usage)
     optParser.add_option(
       "--config",
       action="store",
@@ -162,6 +707,41 @@ class Jiraclient(object):
       help="Store authentication token in this file",
       default=os.path.join(os.environ["HOME"],'.jira-session'),
     )
+    optParser.add_option(
+      "--metadata-cache",
+      action="store",
+      dest="metadata_cache",
+      help="Cache project metadata from the Jira server in this directory",
+      default=os.path.join(os.environ["HOME"],'.jira-metadata'),
+    )
+    optParser.add_option(
+      "--metadata-ttl",
+      action="store",
+      dest="metadata_ttl",
+      help="Seconds before cached metadata is fetched again, 0 disables the cache (default %d)" % self.metadata_ttl,
+      default=None,
+    )
+    optParser.add_option(
+      "--lazy-fields",
+      action="store_true",
+      dest="lazy_fields",
+      help="Fetch custom fields only for the issue types being used",
+      default=False,
+    )
+    optParser.add_option(
+      "--refresh-metadata",
+      action="store_true",
+      dest="refresh_metadata",
+      help="Ignore cached metadata and fetch it again from the Jira server",
+      default=False,
+    )
+    optParser.add_option(
+      "--session-ttl",
+      action="store",
+      dest="session_ttl",
+      help="Seconds to use a stored session without checking it with Jira (default %d)" % self.session_ttl,
+      default=None,
+    )
     optParser.add_option(
       "-a","--api",
       action="store",
@@ -176,6 +756,13 @@ class Jiraclient(object):
       help="JSON data for use with the API option",
       default=None,
     )
+    optParser.add_option(
+      "--stream",
+      action="store_true",
+      dest="stream",
+      help="Write the API option's response to stdout as it arrives, without decoding it",
+      default=False,
+    )
     optParser.add_option(
       "--method",
       action="store",
@@ -183,6 +770,69 @@ class Jiraclient(object):
       help="HTTP method for use with the API option",
       default="get",
     )
+    optParser.add_option(
+      "--jql",
+      action="store",
+      dest="jql",
+      help="Print every issue matching this JQL query, one JSON document per line",
+      default=None,
+    )
+    optParser.add_option(
+      "--transition",
+      action="store",
+      dest="transition",
+      help="Move issues through the workflow transition of this name, or to the status of this name: those matching --jql, given with --issue (comma separated) or listed in --keys.  Prints a JSON result per issue",
+      default=None,
+    )
+    optParser.add_option(
+      "--keys",
+      action="store",
+      dest="keys",
+      help="File of issue keys for --transition, one per line, - for stdin",
+      default=None,
+    )
+    optParser.add_option(
+      "--fields",
+      action="store",
+      dest="fields",
+      help="Comma separated list of issue fields to get with --jql or --display, eg. summary,status",
+      default=None,
+    )
+    optParser.add_option(
+      "--daemon",
+      action="store_true",
+      dest="daemon",
+      help="Stay running and serve jiraclient commands on --socket, keeping the session and metadata",
+      default=False,
+    )
+    optParser.add_option(
+      "--socket",
+      action="store",
+      dest="socket",
+      help="Unix socket of the --daemon, commands are sent there while it's running",
+      default=os.path.join(os.environ["HOME"],'.jira-daemon.sock'),
+    )
+    optParser.add_option(
+      "--batch",
+      action="store",
+      dest="batch",
+      help="Run the operations in this file, one per line, - for stdin.  A line is command line options or a JSON object of option names and values",
+      default=None,
+    )
+    optParser.add_option(
+      "--batch-workers",
+      action="store",
+      dest="batch_workers",
+      help="Run this many --batch operations at once (default 1)",
+      default=None,
+    )
+    optParser.add_option(
+      "--max-results",
+      action="store",
+      dest="max_results",
+      help="Get this many issues per search request (default %d)" % self.max_results,
+      default=None,
+    )
     optParser.add_option(
       "-c","--comment",
       action="store",
@@ -198,6 +848,13 @@ class Jiraclient(object):
       help="Set the log level",
       default="INFO",
     )
+    optParser.add_option(
+      "--log-indent",
+      action="store_true",
+      dest="log_indent",
+      help="Indent log messages by call depth",
+      default=False,
+    )
     optParser.add_option(
       "--labels",
       action="store",
@@ -223,7 +880,79 @@ class Jiraclient(object):
       "--template",
       action="store",
       dest="template",
-      help="Make a set of Issues based on a YAML template file",
+      help="Make a set of Issues based on a YAML template file, one epic per document",
+      default=None,
+    )
+    optParser.add_option(
+      "--template-format",
+      type="choice",
+      choices=["yaml","ndjson"],
+      dest="template_format",
+      help="Read --template as yaml, or ndjson with one epic per line (default by file extension, .ndjson or .jsonl, else yaml)",
+      default=None,
+    )
+    optParser.add_option(
+      "--bulk-size",
+      action="store",
+      dest="bulk_size",
+      help="Create template issues in batches of this many per API call, 0 creates them one at a time (default %d)" % self.bulk_size,
+      default=None,
+    )
+    optParser.add_option(
+      "--workers",
+      action="store",
+      dest="workers",
+      help="Make at most this many API calls at once, eg. when creating template issues (default %d)" % self.workers,
+      default=None,
+    )
+    optParser.add_option(
+      "--max-connections",
+      action="store",
+      dest="max_connections",
+      help="Keep at most this many idle connections to the Jira server for reuse (default %d)" % self.max_connections,
+      default=None,
+    )
+    optParser.add_option(
+      "--retries",
+      action="store",
+      dest="retries",
+      help="Times to retry a request when Jira is busy or unreachable (default %d)" % self.retries,
+      default=None,
+    )
+    optParser.add_option(
+      "--retry-backoff",
+      action="store",
+      dest="retry_backoff",
+      help="Seconds to wait before the first retry, doubling for each one after (default %.1f)" % self.retry_backoff,
+      default=None,
+    )
+    optParser.add_option(
+      "--stats",
+      action="store_true",
+      dest="stats",
+      help="Report the requests made of Jira, by endpoint, when done",
+      default=False,
+    )
+    optParser.add_option(
+      "--stats-format",
+      type="choice",
+      choices=["text","json","prometheus"],
+      dest="stats_format",
+      help="Report --stats as text, json or prometheus (default text)",
+      default="text",
+    )
+    optParser.add_option(
+      "--stats-file",
+      action="store",
+      dest="stats_file",
+      help="Write --stats to this file rather than stderr",
+      default=None,
+    )
+    optParser.add_option(
+      "--idle-timeout",
+      action="store",
+      dest="idle_timeout",
+      help="Seconds to keep a connection to the Jira server for reuse (default %d)" % self.idle_timeout,
       default=None,
     )
     optParser.add_option(
@@ -450,7 +1179,16 @@ class Jiraclient(object):
       help="Set the 'IT Service' for the issue",
       default=None,
     )
-    (self.options, self.args) = optParser.parse_args()
+    return optParser
+
+  def parse_args(self,args=None):
+    self.parser = self.make_parser()
+    (self.options, self.args) = self.parser.parse_args(args)
+
+  def given_options(self):
+    # Options that differ from their defaults, ie. given on the command line
+    defaults = self.parser.get_default_values()
+    return dict([ (k,v) for (k,v) in vars(self.options).items() if getattr(defaults,k,None) != v ])
 
   def prepare_logger(self):
     """prepares a logger optionally to use syslog and with a log level"""
@@ -458,14 +1196,15 @@ class Jiraclient(object):
 
     logger = logging.getLogger("jiraclient")
     if use_syslog:
-      handler = logging.handlers.SysLogHandler(address="/dev/log")
+      from logging.handlers import SysLogHandler
+      handler = SysLogHandler(address="/dev/log")
     else:
       handler = logging.StreamHandler()
 
     datefmt = "%b %d %H:%M:%S"
     fmt = "%(asctime)s %(name)s[%(process)d]: %(levelname)s: %(indent)s %(message)s"
     #fmtr = logging.Formatter(fmt,datefmt)
-    fmtr = IndentFormatter(fmt,datefmt)
+    fmtr = IndentFormatter(fmt,datefmt,indent=self.options.log_indent)
     handler.setFormatter(fmtr)
     logger.handlers = []
     logger.addHandler(handler)
@@ -473,7 +1212,7 @@ class Jiraclient(object):
     self.logger = logger
 
   def read_config(self):
-    self.logger.debug("read config %s" % self.options.config)
+    self.logger.debug("read config %s",self.options.config)
     parser = ConfigParser.ConfigParser()
     parser.optionxform = str
 
@@ -497,7 +1236,7 @@ class Jiraclient(object):
         os.chmod(self.options.config,int("600",8))
 
       if stat.S_IMODE(os.stat(self.options.config).st_mode) != int("600",8):
-        self.logger.warning("Config file %s is not mode 600" % (self.options.config))
+        self.logger.warning("Config file %s is not mode 600",self.options.config)
       try:
         parser.readfp(file(self.options.config,'r'))
       except ConfigParser.ParsingError:
@@ -510,11 +1249,11 @@ class Jiraclient(object):
         # You can't set in rcfile something that isn't also an option.
         self.fatal("Unknown option: %s" % k)
       if getattr(self.options,k) is None:
-        self.logger.debug("take value %s for %s from rc file" % (v,k))
+        self.logger.debug("take value %s for %s from rc file",v,k)
         setattr(self.options,k,v)
 
   def read_issue_defaults(self):
-    self.logger.debug("read issue defaults %s" % self.options.config)
+    self.logger.debug("read issue defaults %s",self.options.config)
     parser = ConfigParser.ConfigParser()
     parser.optionxform = str
     try:
@@ -525,19 +1264,173 @@ class Jiraclient(object):
       self.fatal("Unable to parse file at %r: %s" % (self.options.config,details))
 
     for (k,v) in (parser.items('issues')):
-      self.logger.debug("take value %s for %s from rc file" % (v,k))
+      self.logger.debug("take value %s for %s from rc file",v,k)
       setattr(self.options,k,v)
 
-  def call_api(self,method,uri,payload=None,full=False):
-    self.proxy.uri = "%s/%s" % (self.options.jiraurl, uri)
-    call = getattr(self.proxy,method)
+  def get_pool(self):
+    # Make the connection pool on first use, so that options are known.
+    if self.parent is not None:
+      return self.parent.get_pool()
+    self.lock.acquire()
+    try:
+      if self.pool is None:
+        from restkit.conn import Connection
+        from socketpool import ConnectionPool
+        stats = self.connection_stats
+        lock = self.lock
+        class CountedConnection(Connection):
+          # Count the sockets we open, the rest of requests reused one.
+          def __init__(self,*args,**kwargs):
+            Connection.__init__(self,*args,**kwargs)
+            lock.acquire()
+            stats['connections'] += 1
+            lock.release()
+        self.pool = ConnectionPool(factory=CountedConnection,
+          max_size=self.get_int_option('max_connections',self.max_connections),
+          max_lifetime=self.get_int_option('idle_timeout',self.idle_timeout),
+          backend="thread")
+      return self.pool
+    finally:
+      self.lock.release()
+
+  def get_limiter(self):
+    if self.parent is not None:
+      return self.parent.get_limiter()
+    self.lock.acquire()
+    try:
+      if self.limiter is None:
+        self.limiter = Limiter(self.get_int_option('max_connections',self.max_connections))
+      return self.limiter
+    finally:
+      self.lock.release()
+
+  def get_stats(self):
+    if self.parent is not None:
+      return self.parent.get_stats()
+    self.lock.acquire()
+    try:
+      if self.stats is None:
+        self.stats = RequestStats()
+      return self.stats
+    finally:
+      self.lock.release()
+
+  def report_stats(self):
+    # Write --stats to --stats-file or stderr
+    if not (self.options.stats or self.options.stats_file): return
+    report = self.get_stats().report(self.options.stats_format,self.get_connection_stats())
+    if not self.options.stats_file:
+      sys.stderr.write(report)
+      return
+    # Write and rename, a collector reading it never sees half of it
+    tmpfile = "%s.%d" % (self.options.stats_file,os.getpid())
+    try:
+      fd = open(tmpfile,'w')
+      try:
+        fd.write(report)
+      finally:
+        fd.close()
+      os.rename(tmpfile,self.options.stats_file)
+    except (IOError,OSError), details:
+      self.logger.warning("Unable to write stats to %s: %s",self.options.stats_file,details)
+
+  def response_length(self,response):
+    # The length of a response we haven't read, if it says
+    for (k,v) in response.headers.items():
+      if k.lower() == 'content-length' and v.isdigit():
+        return int(v)
+    return 0
+
+  def retry_after(self,response):
+    # Seconds Jira asked us to wait before trying again, or None
+    headers = dict([ (k.lower(),v) for (k,v) in response.headers.items() ])
+    value = headers.get('retry-after')
+    if value:
+      try:
+        return max(float(value),0)
+      except ValueError:
+        # Retry-After may be an HTTP date
+        import email.utils
+        date = email.utils.parsedate_tz(value)
+        if date:
+          return max(email.utils.mktime_tz(date) - time.time(),0)
+    # Jira Data Center's rate limiter refills FillRate requests per
+    # Interval-Seconds, so one more request is allowed after this long.
+    if headers.get('x-ratelimit-remaining') == '0':
+      try:
+        return float(headers['x-ratelimit-interval-seconds']) / float(headers['x-ratelimit-fillrate'])
+      except (KeyError,ValueError,ZeroDivisionError):
+        pass
+    return None
+
+  def unreachable(self,error):
+    # True if error says nothing listens at the Jira URL, or there's no
+    # such host.  restkit passes socket errors on as text.
+    import errno
+    import socket
+    codes = (errno.ECONNREFUSED,socket.EAI_NONAME)
+    if isinstance(error,socket.error) and error.args:
+      return error.args[0] in codes
+    return [ code for code in codes if "[Errno %d]" % code in str(error) ] != []
+
+  def retry_delay(self,method,error,attempt):
+    # Seconds to wait before retrying a failed request, or None if it
+    # mustn't be retried.
+    if attempt >= self.get_int_option('retries',self.retries):
+      return None
+    status = getattr(error,'status_int',None)
+    if status is None and self.unreachable(error):
+      # Trying again in a few seconds won't change that
+      return None
+    if status in (429,503):
+      # Jira turned the request away without acting on it, so even a POST
+      # is safe to send again.
+      pass
+    elif status in (None,502,504):
+      # We don't know whether Jira acted on it, or it may have timed out
+      # while doing so.  Only repeat requests that can be repeated safely.
+      if method.lower() not in self.idempotent:
+        return None
+    else:
+      return None
+    response = getattr(error,'response',None)
+    if response is not None:
+      delay = self.retry_after(response)
+      if delay is not None:
+        return delay
+    # Exponential backoff, with jitter so that our threads, and other
+    # clients, don't all come back at once.
+    backoff = self.get_float_option('retry_backoff',self.retry_backoff) * 2 ** attempt
+    return random.uniform(backoff / 2,backoff)
+
+  def get_connection_stats(self):
+    stats = dict(self.connection_stats)
+    stats['reused'] = max(stats['requests'] - stats['connections'],0)
+    return stats
+
+  def get_proxy(self):
+    proxy = getattr(self.local,'proxy',None)
+    if proxy is None:
+      from restkit import Resource
+      proxy = Resource('', filters=[], pool=self.get_pool())
+      self.local.proxy = proxy
+    return proxy
+
+  def call_api(self,method,uri,payload=None,full=False,accept=(),reauth=True,items=None):
+    # accept is a list of HTTP error codes whose JSON body is returned
+    # to the caller instead of being fatal.
+    # items returns a generator of the items of the array named items in
+    # the response, eg. 'issues', decoded as they arrive.  Use '' if the
+    # response itself is an array.
+    # reauth says to make a new session and try again if ours has expired.
     headers = {'Content-Type' : 'application/json'}
     if self.token is not None:
       headers['Authorization'] = 'Basic %s' % self.token
-    if self.cookie is not None:
-      headers['Cookie'] = '%s' % self.cookie
+    cookie = self.cookie
+    if cookie is not None:
+      headers['Cookie'] = '%s' % cookie
 
-    self.logger.debug("Call API: %s %s/%s payload=%s headers=%s" % (method,self.options.jiraurl,uri,payload,headers))
+    self.logger.debug("Call API: %s %s/%s payload=%s headers=%s",method,self.options.jiraurl,uri,payload,headers)
     if self.options.noop:
       self.logger.debug("NOOP mode, return before API call")
       return {}
@@ -545,25 +1438,90 @@ class Jiraclient(object):
       self.logger.debug("NOPOST mode, return before API call")
       return {}
 
-    try:
-      response = call(headers=headers,payload=payload)
-    except Unauthorized:
-      if os.path.exists(self.options.sessionfile):
-        os.unlink(self.options.sessionfile)
-      return None
-    except Exception,msg:
-      self.fatal("Unhandled API exception for method: %s: %s" % (self.proxy.uri,msg))
+    from restkit.errors import Unauthorized, ResourceError, RequestError, RequestTimeout
+    import socket
+    proxy = self.get_proxy()
+    proxy.uri = "%s/%s" % (self.options.jiraurl, uri)
+    call = getattr(proxy,method)
+    limiter = self.get_limiter()
+    stats = self.get_stats()
+    sent = len(payload or '')
+    attempt = 0
+    while True:
+      self.lock.acquire()
+      self.connection_stats['requests'] += 1
+      self.lock.release()
+      error = None
+      expired = False
+      limiter.acquire()
+      started = time.time()
+      try:
+        try:
+          response = call(headers=headers,payload=payload)
+        except Unauthorized, msg:
+          if msg.status_int == 401:
+            stats.record(method,uri,time.time() - started,sent,len(msg.msg or ""),error=True)
+            expired = True
+          else:
+            # 403, we're logged in but not allowed to
+            error = msg
+        except (ResourceError,RequestError,RequestTimeout,socket.error),msg:
+          error = msg
+        except Exception,msg:
+          self.fatal("Unhandled API exception for method: %s: %s" % (proxy.uri,msg))
+      finally:
+        limiter.release()
+      if expired:
+        # Make the new session after giving up our slot, making it and
+        # retrying need slots of their own.
+        if reauth and cookie is not None and self.reauthenticate(cookie):
+          return self.call_api(method,uri,payload=payload,full=full,accept=accept,reauth=False,items=items)
+        if os.path.exists(self.options.sessionfile):
+          os.unlink(self.options.sessionfile)
+        return None
+      if error is None:
+        limiter.succeeded()
+        break
+      if getattr(error,'status_int',None) in (429,503):
+        limiter.overloaded()
+      delay = self.retry_delay(method,error,attempt)
+      stats.record(method,uri,time.time() - started,sent,len(getattr(error,'msg','') or ''),error=True,retried=delay is not None)
+      if delay is None:
+        break
+      attempt += 1
+      self.logger.warning("Jira request %s %s failed (%s), retry %d in %.1f seconds",method,uri,getattr(error,'status_int',None) or error,attempt,delay)
+      time.sleep(delay)
+
+    if error is not None:
+      if getattr(error,'status_int',None) not in accept:
+        self.fatal("Unhandled API exception for method: %s: %s" % (proxy.uri,error))
+      self.logger.debug("Response: %s",error.status_int)
+      try:
+        data = json.loads(error.msg)
+      except ValueError:
+        data = None
+      if type(data) is not dict or not (data.get('errorMessages') or data.get('errors')):
+        # Whatever the body says, it's still an error
+        data = dict(data if type(data) is dict else {},errorMessages=["HTTP status %s" % error.status_int])
+      return data
 
-    self.logger.debug("Response: %s" % (response.status_int))
-    if full:
-      return response
+    self.logger.debug("Response: %s",response.status_int)
+    if full or items is not None:
+      # The caller reads the body, we count the time until it starts
+      stats.record(method,uri,time.time() - started,sent,self.response_length(response))
+      if full:
+        return response
+      return iter_response_items(response,items)
+    body = response.body_string()
+    stats.record(method,uri,time.time() - started,sent,len(body))
     try:
-      data = json.loads(response.body_string())
+      data = json.loads(body)
       return data
     except ValueError:
       return {}
 
   def get_project_id(self,projectKey):
+    self.use_project(projectKey)
     if self.maps['project']: return
     if self.options.noop:
       self.maps['project']['0'] = 'noop'
@@ -573,6 +1531,7 @@ class Jiraclient(object):
     self.maps['project'][str(data["id"])] = projectKey.lower()
 
   def get_issue_types(self,projectKey):
+    self.use_project(projectKey)
     if self.maps['issuetype']: return
     if self.options.noop:
       # minimal set of issue types for tests to work
@@ -580,21 +1539,47 @@ class Jiraclient(object):
       self.maps['issuetype']['2'] = 'story'
       self.maps['issuetype']['3'] = 'task'
       self.maps['issuetype']['4'] = 'sub-task'
-    else:
-      self.check_auth()
+    elif self.options.lazy_fields:
+      # Only the issue types, get_customfields() fetches fields when needed
       uri = 'rest/api/latest/issue/createmeta?projectKeys=%s' % (projectKey)
       data = self.call_api("get",uri)
       for item in data['projects'][0]['issuetypes']:
           self.maps['issuetype'][str(item['id'])] = str(item['name'].lower())
-    self.logger.debug("types: %s" % self.maps['issuetype'])
+    else:
+      # One request gets issue types and custom fields of every type
+      self.get_createmeta(projectKey)
+    self.logger.debug("types: %s",self.maps['issuetype'])
 
-  def get_customfields(self,projectKey,issueType):
+  def get_createmeta(self,projectKey,issueType=None):
     # More general support of customfields would depend on specifically
     # supporting the REST API, because different JIRA widgets have different
     # object constructions. Some are key/value pairs, some are lists, some are
     # dictionaries.
     # https://developer.atlassian.com/jiradev/jira-apis/jira-rest-apis/jira-rest-api-tutorials/jira-rest-api-example-create-issue
-    self.logger.debug("get customfields: %s %s" % (projectKey,issueType))
+    self.use_project(projectKey)
+    uri = 'rest/api/latest/issue/createmeta?projectKeys=%s&expand=projects.issuetypes.fields' % (projectKey)
+    if issueType is not None:
+      uri += '&issuetypeIds=%s' % issueType
+    data = self.call_api("get",uri)
+    for item in data['projects'][0]['issuetypes']:
+      itype = str(item['id'])
+      self.maps['issuetype'][itype] = str(item['name'].lower())
+      fields = SearchableDict()
+      for (field,meta) in item['fields'].items():
+        if not field.startswith('customfield'): continue
+        if meta.has_key('allowedValues'):
+          fields[str(field)] = {
+            'name'  : str(meta['name'].lower()),
+            'values': [ str(value_dict['value']) for value_dict in meta['allowedValues'] if value_dict.has_key('value') ],
+          }
+        else:
+          fields[str(field)] = str(meta['name'].lower())
+      self.maps['customfields'][itype] = fields
+    self.logger.debug("customfields map: %s",self.maps['customfields'])
+
+  def get_customfields(self,projectKey,issueType):
+    self.logger.debug("get customfields: %s %s",projectKey,issueType)
+    self.use_project(projectKey)
     if not self.maps['project']: return
     if not self.maps['issuetype']: return
     if issueType in self.maps['customfields']: return
@@ -610,28 +1595,12 @@ class Jiraclient(object):
         self.maps['customfields'][str(tid)]['customfield_00000'] = 'epic/theme'
         self.maps['customfields'][str(tid)]['customfield_00001'] = 'epic link'
     else:
-      pid = self.maps['project'].find_key(projectKey.lower())
-      #tid = self.maps['issuetype'].find_key(issueType)
-      uri = 'rest/api/latest/issue/createmeta?projectIds=%s&issuetypeIds=%s&expand=projects.issuetypes.fields' % (pid,issueType)
-      data = self.call_api("get",uri)
-      for item in data['projects'][0]['issuetypes']:
-        for field in item['fields']:
-          if field.startswith('customfield'):
-
-            if issueType not in self.maps['customfields'].keys():
-              self.maps['customfields'][str(issueType)] = SearchableDict()
-
-            if item['fields'][field].has_key('allowedValues'):
-              self.maps['customfields'][str(issueType)][str(field)] = {}
-              self.maps['customfields'][str(issueType)][str(field)]['values'] = []
-              self.maps['customfields'][str(issueType)][str(field)]['name'] = str(item['fields'][field]['name'].lower())
-              for value_dict in item['fields'][field]['allowedValues']:
-                self.maps['customfields'][str(issueType)][str(field)]['values'].append( str(value_dict['value']) )
-            else:
-
-              self.maps['customfields'][str(issueType)][str(field)] = str(item['fields'][field]['name'].lower())
-
-    self.logger.debug("customfields map: %s" % self.maps['customfields'])
+      # Fields of issue types are all fetched by get_issue_types(), unless
+      # --lazy-fields said to wait until an issue type is used.
+      self.get_createmeta(projectKey,issueType)
+      if self.maps_source is not None:
+        # Remember these fields next time too
+        self.save_metadata_cache()
 
   def get_resolutions(self):
     if self.maps['resolutions']: return
@@ -643,18 +1612,41 @@ class Jiraclient(object):
       for item in data:
         self.maps['resolutions'][str(item['id'])] = str(item['name'].lower()) 
 
-  def get_transitions(self,issueKey):
-    if self.maps['transitions']: return
+  def get_transitions(self,issueKey,issuetype=None,status=None):
+    # The transitions issueKey can make, a SearchableDict of transition ids
+    # to their name and the status they go 'to'.  They're decided by the
+    # workflow of the issue's project and type, and by its status, so given
+    # the issue type and status ids they're fetched once for all issues in
+    # that state.
+    state = None
+    if issuetype is not None and status is not None:
+      state = (issueKey.split('-')[0].upper(),str(issuetype),str(status))
+      transitions = self.transition_maps.get(state)
+      if transitions is not None:
+        return transitions
+    transitions = SearchableDict()
     if self.options.noop:
-        self.maps['transitions']['0'] = 'noop'
+      transitions['0'] = {'name': 'noop', 'to': 'noop'}
     else:
       uri = 'rest/api/latest/issue/%s/transitions' % issueKey
       data = self.call_api("get",uri)
       for item in data['transitions']:
-        item = item['to']
-        self.maps['transitions'][str(item['id'])] = str(item['name'].lower()) 
+        transitions[str(item['id'])] = {'name': str(item['name'].lower()), 'to': str(item['to']['name'].lower())}
+    if state is not None:
+      self.transition_maps.put(state,transitions)
+    return transitions
+
+  def find_transition(self,transitions,name):
+    # The id of the transition called name, or else of one to status name
+    transition_id = transitions.find_key(name)
+    if transition_id is None:
+      for (tid,transition) in transitions.items():
+        if transition['to'] == name.lower():
+          return tid
+    return transition_id
 
   def get_project_versions(self,projectKey):
+    self.use_project(projectKey)
     if self.maps['fixversions']: return
     if self.options.noop:
       self.maps['versions']['0'] = 'noop'
@@ -666,6 +1658,7 @@ class Jiraclient(object):
     self.maps['fixversions'] = self.maps['versions']
 
   def get_project_components(self,projectKey):
+    self.use_project(projectKey)
     if self.maps['components']: return
     if self.options.noop:
         self.maps['components']['0'] = 'noop'
@@ -685,19 +1678,158 @@ class Jiraclient(object):
       for item in data:
         self.maps['priority'][str(item['id'])] = str(item['name'].lower())
 
+  def metadata_cache_file(self):
+    # One cache file per Jira server and project
+    key = "%s|%s" % (self.options.jiraurl, str(self.options.project).lower())
+    import hashlib
+    name = "%s.json" % hashlib.md5(key).hexdigest()
+    return os.path.join(os.path.expanduser(self.options.metadata_cache), name)
+
+  def get_int_option(self,name,default):
+    # Numeric options may come from the rc file as strings
+    value = getattr(self.options,name,None)
+    if value is None:
+      return default
+    try:
+      return int(value)
+    except ValueError:
+      self.fatal("Option %s must be a number: %s" % (name,value))
+
+  def get_float_option(self,name,default):
+    value = getattr(self.options,name,None)
+    if value is None:
+      return default
+    try:
+      return float(value)
+    except ValueError:
+      self.fatal("Option %s must be a number: %s" % (name,value))
+
+  def get_metadata_ttl(self):
+    return self.get_int_option('metadata_ttl',self.metadata_ttl)
+
+  def load_metadata_cache(self):
+    # Fill self.maps from the on-disk cache, return True if we did.
+    if self.options.noop or not self.options.metadata_cache: return False
+    if self.options.refresh_metadata: return False
+    ttl = self.get_metadata_ttl()
+    if ttl <= 0: return False
+    cachefile = self.metadata_cache_file()
+    if not os.path.exists(cachefile): return False
+    try:
+      fd = open(cachefile,'r')
+      try:
+        data = json.load(fd)
+      finally:
+        fd.close()
+    except Exception, details:
+      self.logger.warning("Ignoring unreadable metadata cache %s: %s",cachefile,details)
+      return False
+    if data.get('version') != self.metadata_cache_version:
+      self.logger.debug("metadata cache %s has wrong version",cachefile)
+      return False
+    if time.time() - data.get('time',0) > ttl:
+      self.logger.debug("metadata cache %s is expired",cachefile)
+      return False
+
+    maps = self.empty_maps()
+    for (name,values) in data['maps'].items():
+      if name not in maps: continue
+      if name == 'customfields':
+        for (itype,fields) in values.items():
+          maps[name][str(itype)] = SearchableDict(unicode_to_str(fields))
+      elif name in self.global_maps:
+        # Unless another project's maps already filled them
+        if not maps[name]:
+          maps[name].update(unicode_to_str(values))
+      else:
+        maps[name] = SearchableDict(unicode_to_str(values))
+    maps['fixversions'] = maps['versions']
+    self.maps = maps
+    self.maps_source = 'cache'
+    if self.serverinfo is None and data.get('serverinfo'):
+      self.serverinfo = unicode_to_str(data['serverinfo'])
+    self.logger.debug("read metadata cache %s",cachefile)
+    return True
+
+  def save_metadata_cache(self):
+    if self.options.noop or not self.options.metadata_cache: return
+    if self.get_metadata_ttl() <= 0: return
+    cachefile = self.metadata_cache_file()
+    cachedir = os.path.dirname(cachefile)
+    maps = dict([ (k,v) for (k,v) in self.maps.items() if k != 'fixversions' ])
+    data = {
+      'version': self.metadata_cache_version,
+      'jiraurl': self.options.jiraurl,
+      'project': self.options.project,
+      'time'   : time.time(),
+      'maps'   : maps,
+      'serverinfo': self.serverinfo,
+    }
+    try:
+      if not os.path.exists(cachedir):
+        os.makedirs(cachedir,int("700",8))
+      # Write and rename so concurrent runs never read a partial file
+      tmpfile = "%s.%d" % (cachefile,os.getpid())
+      fd = open(tmpfile,'w')
+      try:
+        json.dump(data,fd)
+      finally:
+        fd.close()
+      os.chmod(tmpfile,int("600",8))
+      os.rename(tmpfile,cachefile)
+    except (IOError,OSError), details:
+      self.logger.warning("Unable to write metadata cache %s: %s",cachefile,details)
+      return
+    self.logger.debug("wrote metadata cache %s",cachefile)
+
+  def refresh_metadata_cache(self):
+    # Called when a lookup misses.  If our maps came from the cache they may
+    # be stale, so fetch them again from the server.  Return True if the
+    # maps were refreshed and the lookup is worth retrying.
+    if self.maps_source != 'cache': return False
+    self.logger.debug("metadata lookup missed, refresh metadata cache")
+    self.maps = self.empty_maps()
+    # Fetch priorities and resolutions too, then add them to the ones every
+    # project shares rather than empty those under other threads' feet.
+    for name in self.global_maps:
+      self.maps[name] = SearchableDict()
+    self.maps_source = None
+    refresh = self.options.refresh_metadata
+    self.options.refresh_metadata = True
+    try:
+      self.update_maps_from_jiraserver()
+    finally:
+      self.options.refresh_metadata = refresh
+    for (name,shared) in self.global_maps.items():
+      shared.update(self.maps[name])
+      self.maps[name] = shared
+    return True
+
   def update_maps_from_jiraserver(self):
     self.logger.debug("update maps from jira server")
+    self.use_project(self.options.project)
+    if self.maps_source is None and self.load_metadata_cache():
+      self.keep_maps()
+      return
     # Need project first.
     # These need to happen before any issue creation or modification
     self.get_project_id(self.options.project)
     self.get_issue_types(self.options.project)
-    for itype in self.maps['issuetype']:
-      self.get_customfields(self.options.project,itype)
+    if not self.options.lazy_fields:
+      for itype in self.maps['issuetype']:
+        self.get_customfields(self.options.project,itype)
     self.get_project_versions(self.options.project)
     self.get_project_components(self.options.project)
     self.get_resolutions()
     self.get_priorities()
-    self.logger.debug("maps: %s" % self.maps)
+    self.logger.debug("maps: %s",self.maps)
+    if self.maps_source is None:
+      self.maps_source = 'server'
+      if not self.options.noop and self.serverinfo is None:
+        # Keep server info in the cache too, it's needed by most actions
+        self.serverinfo = self.get_serverinfo()
+      self.save_metadata_cache()
+    self.keep_maps()
 
   def get_serverinfo(self):
     uri = 'rest/api/latest/serverInfo'
@@ -706,33 +1838,234 @@ class Jiraclient(object):
       result = {"baseUrl":self.options.jiraurl}
     return result
 
-  def get_issue(self,issueID):
+  @property
+  def server_info(self):
+    # Server info (baseUrl, version, deploymentType) never changes during a
+    # run, fetch it at most once, if the metadata cache didn't have it.
+    if self.serverinfo is None:
+      self.serverinfo = self.get_serverinfo()
+    return self.serverinfo
+
+  @property
+  def server_version(self):
+    # The Jira version as a tuple of ints, eg. (6,4,3), or None if unknown.
+    info = self.server_info
+    if 'versionNumbers' in info:
+      return tuple(info['versionNumbers'])
+    if 'version' in info:
+      m = re.match(r'^(\d+(\.\d+)*)',info['version'])
+      if m:
+        return tuple([ int(n) for n in m.group(1).split('.') ])
+    return None
+
+  def supports_bulk_create(self):
+    # POST issue/bulk appeared in Jira 6.0.  Assume it's there if we can't
+    # tell, eg. in noop mode.
+    version = self.server_version
+    return version is None or version >= (6,0)
+
+  def selection(self,fields=None,expand=None):
+    # Query parameters asking Jira for only some of an issue.  fields and
+    # expand may be lists or comma separated strings.
+    params = []
+    for (name,value) in (('fields',fields),('expand',expand)):
+      if value:
+        if not isinstance(value,basestring):
+          value = ','.join(value)
+        params.append((name,value))
+    return params
+
+  def issue_uri(self,issueID,fields=None,expand=None):
     uri = 'rest/api/latest/issue/%s' % issueID
+    params = self.selection(fields,expand)
+    if params:
+      import urllib
+      uri += '?' + urllib.urlencode(params)
+    return uri
+
+  def get_issue(self,issueID,fields=None,expand=None):
+    uri = self.issue_uri(issueID,fields,expand)
     return self.call_api("get",uri)
 
+  def search_page(self,jql,startAt,maxResults,fields=None,expand=None,validate=True,items=None):
+    # items='issues' returns a generator of the page's issues, decoded as
+    # they arrive, see call_api()
+    params = [('jql',jql),('startAt',startAt),('maxResults',maxResults)]
+    params.extend(self.selection(fields,expand))
+    if not validate:
+      # eg. keys of issues that don't exist aren't an error
+      params.append(('validateQuery','false'))
+    import urllib
+    uri = 'rest/api/latest/search?%s' % urllib.urlencode(params)
+    return self.call_api('get',uri,items=items)
+
+  def search(self,jql,fields=None,expand=None,max_results=None,validate=True):
+    # Yield every issue matching jql.  The first page says how many issues
+    # there are, then further pages are fetched ahead on --workers threads
+    # while the caller works through the current one.  The workers decode
+    # those pages an issue at a time, so a page's body and its decoded
+    # document aren't both held at once.
+    if max_results is None:
+      max_results = self.get_int_option('max_results',self.max_results)
+    page = self.search_page(jql,0,max_results,fields,expand,validate)
+    if not page: return
+    for issue in page.get('issues',[]):
+      yield issue
+
+    # Jira may return fewer issues per page than we asked for
+    step = page.get('maxResults') or max_results
+    starts = range(step,page.get('total',0),step)
+    def fetch(start):
+      return list(self.search_page(jql,start,step,fields,expand,validate,items='issues') or [])
+    for page in self.imap(fetch,starts):
+      for issue in page:
+        yield issue
+
+  def get_worklogs(self,issueID):
+    # Jira may page worklogs, see startAt and total
+    worklogs = []
+    start = 0
+    size = self.get_int_option('max_results',self.max_results)
+    while True:
+      uri = 'rest/api/latest/issue/%s/worklog?startAt=%d&maxResults=%d' % (issueID,start,size)
+      data = self.call_api('get',uri)
+      if not data: break
+      page = data.get('worklogs',[])
+      worklogs.extend(page)
+      start = data.get('startAt',start) + len(page)
+      if not page or start >= data.get('total',0): break
+    return worklogs
+
   def delete_issue(self,issueID):
     uri = 'rest/api/latest/issue/%s?deleteSubtasks=true' % issueID
     result = self.call_api('delete',uri)
-    self.logger.info("Deleted %s/browse/%s" % (self.get_serverinfo()['baseUrl'], issueID))
+    self.logger.info("Deleted %s/browse/%s",self.server_info['baseUrl'],issueID)
     return result
 
   def resolve_issue(self,issueID,resolution):
     resolution = resolution[0].upper() + resolution[1:].lower()
-    self.get_transitions(issueID)
+    transitions = self.get_transitions(issueID)
     uri = 'rest/api/latest/issue/%s/transitions' % issueID
-    transition_id = self.maps['transitions'].find_key("resolved")
+    transition_id = self.find_transition(transitions,"resolved")
     payload = json.dumps({"transition":{"id": transition_id},"fields":{"resolution":{"name":resolution}}})
     result = self.call_api("post",uri,payload=payload)
-    self.logger.info("Resolved %s/browse/%s" % (self.get_serverinfo()['baseUrl'], issueID))
+    self.logger.info("Resolved %s/browse/%s",self.server_info['baseUrl'],issueID)
     return result
 
-  def display_issue(self,issueID):
-    uri = 'rest/api/latest/issue/%s' % issueID
+  def transition_keys(self):
+    # Issue keys given with --issue, which may be a comma separated list,
+    # and listed in the --keys file
+    if self.options.issueID:
+      for key in self.options.issueID.split(','):
+        yield key.strip()
+    if not self.options.keys: return
+    if self.options.keys == '-':
+      fd = sys.stdin
+    else:
+      fd = open(os.path.expanduser(self.options.keys),'r')
+    try:
+      for line in iter(fd.readline,''):
+        key = line.strip()
+        if key and not key.startswith('#'):
+          yield key
+    finally:
+      if fd is not sys.stdin:
+        fd.close()
+
+  def transition_issues(self):
+    # Yield (key,issue) for the issues to transition, with their type and
+    # status, issue is None if there's no such issue.  Keys are looked up a
+    # page at a time.
+    fields = 'issuetype,status'
+    size = self.get_int_option('max_results',self.max_results)
+    keys = self.transition_keys()
+    while True:
+      page = list(itertools.islice(keys,size))
+      if not page: break
+      valid = [ key for key in page if issue_key_rx.match(key) ]
+      found = {}
+      if valid:
+        jql = "key in (%s)" % ",".join(valid)
+        for issue in self.search(jql,fields=fields,max_results=size,validate=False):
+          found[issue['key'].upper()] = issue
+      for key in page:
+        yield (key,found.get(key.upper()))
+    if self.options.jql is not None:
+      for issue in self.search(self.options.jql,fields=fields):
+        yield (issue['key'],issue)
+
+  def transition_jobs(self,name):
+    # Yield (key,transition id,error) for each issue to transition.  Issues
+    # of one project, type and status share their transitions, which
+    # get_transitions() fetches for the first of them.
+    for (key,issue) in self.transition_issues():
+      if issue is None:
+        yield (key,None,"No such issue")
+        continue
+      status = issue['fields']['status']
+      try:
+        transitions = self.get_transitions(key,issue['fields']['issuetype']['id'],status['id'])
+      except SystemExit, details:
+        yield (key,None,fatal_message(details))
+        continue
+      transition_id = self.find_transition(transitions,name)
+      if transition_id is None:
+        yield (key,None,"No transition %s from status %s" % (name,status['name']))
+      else:
+        yield (key,transition_id,None)
+
+  def transition_issue(self,job):
+    # Make a transition of transition_jobs(), returns its result
+    (key,transition_id,error) = job
+    result = {'key': key, 'ok': False}
+    if error is not None:
+      result['error'] = error
+      return result
+    data = {'transition': {'id': transition_id}}
+    if self.options.resolve:
+      resolution = self.options.resolve[0].upper() + self.options.resolve[1:].lower()
+      data['fields'] = {'resolution': {'name': resolution}}
+    if self.options.comment:
+      data['update'] = {'comment': [{'add': {'body': self.options.comment}}]}
+    uri = 'rest/api/latest/issue/%s/transitions' % key
+    try:
+      # Jira's reasons for refusing one issue are its result
+      response = self.call_api('post',uri,payload=json.dumps(data),accept=(400,403,404,409))
+    except SystemExit, details:
+      result['error'] = fatal_message(details)
+      return result
+    if response is None:
+      result['error'] = "Not logged in to Jira"
+      return result
+    if response.get('errorMessages') or response.get('errors'):
+      result['error'] = response.get('errorMessages') or response.get('errors')
+      return result
+    result.update(ok=True,transition=transition_id)
+    return result
+
+  def run_transitions(self):
+    # Make --transition for each issue, --workers at a time, and print a
+    # JSON result per issue, in order, as they're done.
+    if not (self.options.issueID or self.options.keys or self.options.jql):
+      self.fatal("Please specify the issues to transition with --issue, --keys or --jql")
+    (count,failed) = (0,0)
+    for result in self.imap(self.transition_issue,self.transition_jobs(self.options.transition)):
+      count += 1
+      if not result['ok']:
+        failed += 1
+      sys.stdout.write(json.dumps(result) + "\n")
+      sys.stdout.flush()
+    self.logger.info("Made %d of %d transitions",count - failed,count)
+    if failed:
+      self.fatal("%d of %d transitions failed" % (failed,count))
+
+  def display_issue(self,issueID,fields=None,expand=None):
+    uri = self.issue_uri(issueID,fields,expand)
     result = self.call_api('get',uri)
     print json.dumps(result)
 
-  def fetch_issue(self,issueID):
-    uri = 'rest/api/latest/issue/%s' % issueID
+  def fetch_issue(self,issueID,fields=None,expand=None):
+    uri = self.issue_uri(issueID,fields,expand)
     return self.call_api('get',uri)
 
   def add_comment(self,issueID,comment):
@@ -742,21 +2075,12 @@ class Jiraclient(object):
     return result
 
   def clean_issue(self,issue):
-    # We have an Issue with a number of required default values
-    # that are often empty.  Remove the empty ones so as to not
-    # confuse the API service.
-    self.logger.debug("clean issue start: %s" % issue)
+    # The REST fields of an Issue, or of a dict of fields, without empty
+    # values so as to not confuse the API service.  Always a new dict, the
+    # caller's issue is left as it was.
     if type(issue) is not dict:
-      issue = issue.__dict__
-    for k,v in issue.items():
-      if not v: issue.pop(k)
-      if v == {"id":None}: issue.pop(k)
-      if v == {"name":None}: issue.pop(k)
-      if v == {"key":None}: issue.pop(k)
-      if v == {"originalEstimate":None}: issue.pop(k)
-      if v == [{"id":None}]: issue.pop(k)
-    self.logger.debug("cleaned issue: %s" % issue)
-    return issue
+      return issue.fields()
+    return dict([ (k,v) for (k,v) in issue.items() if v and v != Issue.empty.get(k) ])
 
   def create_issue(self,issueObj):
     issue = self.clean_issue(issueObj)
@@ -766,13 +2090,80 @@ class Jiraclient(object):
     issueID = "NOOP"
     if newissue:
       issueID = newissue["key"]
-    self.logger.info("Created %s/browse/%s" % (self.get_serverinfo()['baseUrl'], issueID))
+    self.logger.info("Created %s/browse/%s",self.server_info['baseUrl'],issueID)
     self.issues_created.append(issue)
     return issueID
 
+  def create_issues(self,issueObjs):
+    # Create many issues with as few API calls as possible.  Returns the new
+    # issue keys in the same order as issueObjs, None for any that failed.
+    size = self.get_int_option('bulk_size',self.bulk_size)
+    if size <= 0 or not self.supports_bulk_create():
+      return [ self.create_issue(issue) for issue in issueObjs ]
+    keys = []
+    for start in range(0,len(issueObjs),size):
+      keys.extend(self.create_issues_bulk(issueObjs[start:start+size]))
+    return keys
+
+  def create_issues_bulk(self,issueObjs):
+    issues = [ self.clean_issue(issueObj) for issueObj in issueObjs ]
+    payload = json.dumps({"issueUpdates":[ {"fields":issue} for issue in issues ]})
+    uri = 'rest/api/latest/issue/bulk'
+    # Jira answers 400 if every issue in the batch failed, the body still
+    # describes the errors per issue.
+    result = self.call_api('post',uri,payload=payload,accept=(400,))
+    if result is None:
+      self.fatal("Bulk issue creation failed")
+
+    keys = []
+    if not result:
+      # noop or nopost mode
+      keys = [ "NOOP" for issue in issues ]
+    else:
+      # Errors carry the index of the failed issue, successful issues are
+      # returned in request order.
+      failed = {}
+      errors = result.get('errors') or []
+      if type(errors) is list:
+        for error in errors:
+          if type(error) is dict and error.get('failedElementNumber') is not None:
+            failed[error['failedElementNumber']] = self.format_bulk_error(error)
+        errors = {}
+      # Anything else, like the {field: message} of Jira's other errors, is
+      # about the request, and the reason for issues that weren't created.
+      messages = list(result.get('errorMessages') or [])
+      if type(errors) is dict:
+        messages.extend([ "%s: %s" % (field,message) for (field,message) in errors.items() ])
+      elif errors:
+        messages.append(str(errors))
+      reason = "; ".join(messages) or "Jira returned no key"
+      created = iter(result.get('issues') or [])
+      for (n,issue) in enumerate(issues):
+        new = None
+        if n not in failed:
+          new = next(created,None)
+        if type(new) is not dict or not new.get('key'):
+          self.logger.error("Failed to create issue '%s': %s",issue.get('summary'),failed.get(n,reason))
+          keys.append(None)
+        else:
+          keys.append(new['key'])
+
+    for (issue,issueID) in zip(issues,keys):
+      if issueID is None: continue
+      self.logger.info("Created %s/browse/%s",self.server_info['baseUrl'],issueID)
+      self.issues_created.append(issue)
+    return keys
+
+  def format_bulk_error(self,error):
+    errors = error.get('elementErrors',{})
+    messages = list(errors.get('errorMessages',[]))
+    for (field,message) in errors.get('errors',{}).items():
+      messages.append("%s: %s" % (field,message))
+    return "; ".join(messages) or "HTTP status %s" % error.get('status')
+
   def modify_issue(self,issueID,issueObj):
     issue = self.clean_issue(issueObj)
-    self.logger.debug("modify issue: %s %s" % (issueID,issue))
+    self.logger.debug("modify issue: %s %s",issueID,issue)
     # FIXME: I'm not sure of a good way to see if we just said --issue with no other options.
     # So this is a hack to check to see if that's the case.
     issuecopy = issue
@@ -780,14 +2171,14 @@ class Jiraclient(object):
     if not issuecopy:
       # We specified nothing but --issue, in that case, just display that issue
       # This is like --display --issue FOO-123
-      return self.display_issue(issueID)
+      return self.display_issue(issueID,fields=self.options.fields)
     payload = json.dumps({"fields":issue})
     uri = 'rest/api/latest/issue/%s' % issueID
     self.call_api('put',uri,payload=payload)
-    self.logger.info("Modified issue %s/browse/%s" % (self.get_serverinfo()['baseUrl'], issueID))
+    self.logger.info("Modified issue %s/browse/%s",self.server_info['baseUrl'],issueID)
 
   def get_issue_links(self,issueID):
-    uri = 'rest/api/latest/issue/%s' % issueID
+    uri = self.issue_uri(issueID,fields='issuelinks')
     data = self.call_api('get',uri)
     return data['fields']['issuelinks']
 
@@ -797,7 +2188,7 @@ class Jiraclient(object):
 
   def get_session(self):
     uri = 'rest/auth/latest/session'
-    return self.call_api("get",uri,full=True)
+    return self.call_api("get",uri,full=True,reauth=False)
 
   def read_password(self):
     if not self.options.password:
@@ -805,27 +2196,102 @@ class Jiraclient(object):
       pw = getpass.getpass("Jira password: ")
       self.options.password = pw
 
+  def read_session(self):
+    # Returns what we know of the stored session, or None
+    fd = open(self.options.sessionfile,'r')
+    data = fd.read()
+    fd.close()
+    try:
+      session = json.loads(data)
+    except ValueError:
+      # Older versions stored only the cookie
+      session = {'cookie': data}
+    if not isinstance(session,dict) or not session.get('cookie'):
+      return None
+    return unicode_to_str(session)
+
+  def write_session(self,cookie,issued=None):
+    sessionfile = self.options.sessionfile
+    self.session = {
+      'cookie'  : cookie,
+      'issued'  : issued or time.time(),
+      'lifetime': self.get_session_lifetime(),
+      'observed': self.observed_lifetime,
+    }
+    fd = open(sessionfile,'w')
+    os.chmod(sessionfile,int("600",8))
+    json.dump(self.session,fd)
+    fd.close()
+
+  def get_session_lifetime(self):
+    lifetime = self.get_int_option('session_ttl',self.session_ttl)
+    if self.observed_lifetime is not None:
+      lifetime = min(lifetime,self.observed_lifetime)
+    return lifetime
+
+  def session_is_fresh(self,session):
+    if not session.get('issued') or not session.get('lifetime'):
+      return False
+    return time.time() - session['issued'] < session['lifetime']
+
+  def reauthenticate(self,cookie):
+    # A request using cookie was refused, so the session expired sooner than
+    # we expected.  Remember how long it lasted and make a new one.  Returns
+    # True if there is a new session to retry the request with.
+    if self.parent is not None:
+      # Make one new session for all of the parent's Jiraclients
+      renewed = self.parent.reauthenticate(cookie)
+      self.cookie = self.parent.cookie
+      self.session = self.parent.session
+      return renewed
+    self.auth_lock.acquire()
+    try:
+      if self.cookie != cookie:
+        # Another thread already made a new session
+        return self.cookie is not None
+      if self.session and self.session.get('issued'):
+        self.observed_lifetime = max(int(time.time() - self.session['issued']),60)
+      self.logger.debug("session expired, authenticate again")
+      self.cookie = None
+      self.session = None
+      if os.path.exists(self.options.sessionfile):
+        os.unlink(self.options.sessionfile)
+      self.check_auth()
+      return self.cookie is not None
+    finally:
+      self.auth_lock.release()
+
   def check_auth(self):
     if self.options.noop: return
+    if self.cookie is not None and self.session and self.session_is_fresh(self.session): return
     self.logger.debug("Check authentication")
     sessionfile = self.options.sessionfile
 
     # Don't allow insecure cookie file
     if os.path.exists(sessionfile) and stat.S_IMODE(os.stat(sessionfile).st_mode) != int("600",8):
-        self.logger.error("session file %s is not mode 600, forcing new session" % (sessionfile))
+        self.logger.error("session file %s is not mode 600, forcing new session",sessionfile)
         os.unlink(sessionfile)
 
     # Read existing session
     if os.path.exists(sessionfile):
       self.logger.debug("read auth session")
-      fd = open(sessionfile,'r')
-      self.cookie = fd.read()
-      fd.close()
-      # Check if it's still valid
-      response = self.get_session()
-      if type(response).__name__ == 'Response' and response.status_int == 200:
-        # Cookie still valid, use it
-        return
+      session = self.read_session()
+      if session is not None:
+        self.cookie = session['cookie']
+        if session.get('observed'):
+          self.observed_lifetime = session['observed']
+        if self.session_is_fresh(session):
+          # Recently made, trust it without asking Jira.  If it has expired
+          # after all, call_api() will get a new one.
+          self.logger.debug("auth session is fresh")
+          self.session = session
+          return
+        # Check if it's still valid
+        response = self.get_session()
+        if type(response).__name__ == 'Response' and response.status_int == 200:
+          # Cookie still valid, use it.  Using it keeps it alive in Jira.
+          self.write_session(self.cookie)
+          return
       # Get a new cookie below
       self.cookie = None
       if os.path.exists(sessionfile):
@@ -835,6 +2301,7 @@ class Jiraclient(object):
     if not self.options.password:
       self.read_password()
 
+    import base64
     self.token = base64.b64encode("%s:%s" % (self.options.user, self.options.password))
     response = self.get_session()
     if response is None:
@@ -850,10 +2317,7 @@ class Jiraclient(object):
 
     # Clear token and use cookie
     self.token = None
-    fd = open(sessionfile,'w')
-    fd.write(cookie)
-    fd.close()
-    os.chmod(sessionfile,int("600",8))
+    self.write_session(cookie)
 
   def update_dict_value(self,adict,attribute,value):
     # Take a dict like { 'id': something } and put in the right value
@@ -871,6 +2335,8 @@ class Jiraclient(object):
         amap = self.maps[attribute.lower()]
         if type(value) is str and value.isdigit():
           # Special case if we specify an ID directly
+          if not amap.has_key(str(value)) and self.refresh_metadata_cache():
+            amap = self.maps[attribute.lower()]
           if amap.has_key(str(value)):
             id_of_value = value
           else:
@@ -878,24 +2344,27 @@ class Jiraclient(object):
         else:
           # Find the id of the value from the maps
           id_of_value = amap.find_key(value.lower())
+          if id_of_value is None and self.refresh_metadata_cache():
+            amap = self.maps[attribute.lower()]
+            id_of_value = amap.find_key(value.lower())
       if id_of_value is None:
         self.fatal("You specified '%s' for attribute '%s', known values are: %s" % (value,attribute,amap))
 
       newdict['id'] = str(id_of_value)
     else:
       # Key is 'name' or 'key' and needs no lookup
-      #self.logger.debug("value type: %s" % (type(value)))
+      #self.logger.debug("value type: %s",type(value))
       if type(value) is str or type(value) is unicode:
         newdict[key] = str(value)
       elif type(value) is dict:
         newdict[key] = value
       else:
         raise ValueError("Unhandled value for input: %s %s" % (key,value))
-    self.logger.debug("convert %s to %s" % (adict,newdict))
+    self.logger.debug("convert %s to %s",adict,newdict)
     return newdict
 
   def update_issue_obj(self,issue,attribute,value):
-    self.logger.debug("update issue (%s) attribute (%s) value (%s)" % (issue,attribute,value))
+    self.logger.debug("update issue (%s) attribute (%s) value (%s)",issue,attribute,value)
 
     if not attribute or not value:
       # Return unmodified issue
@@ -932,22 +2401,21 @@ class Jiraclient(object):
     # Is the attr a string, list of strings, dict or list of dicts?
     if type(attr) is str:
       # If attr is a string, set the value and we're done
-      self.logger.debug("set str attr: %s %s" % (attribute,value))
+      self.logger.debug("set str attr: %s %s",attribute,value)
       setattr(issue,attribute,str(value))
     elif type(attr) is list:
       # List of dicts or list of labels
-      self.logger.debug("updating list %s" % attr)
+      self.logger.debug("updating list %s",attr)
       if len(attr) == 0 or type(attr[0]) is str:
         # This is the labels list, append and we're done
-        attr = getattr(issue,attribute)
-        attr.append(str(value))
+        setattr(issue,attribute,getattr(issue,attribute) + [str(value)])
       else:
         # This is a list of dicts.
         # Assume we can have only one value...
         item = attr.pop()
         # Now modify the value...
         newvalue = self.update_dict_value(item,attribute,value)
-        self.logger.debug("set issue (%s) attribute (%s) value (%s)" % (issue,attribute,newvalue))
+        self.logger.debug("set issue (%s) attribute (%s) value (%s)",issue,attribute,newvalue)
         setattr(issue,attribute,[newvalue])
     elif type(attr) is dict:
       setattr(issue,attribute,self.update_dict_value(attr,attribute,value))
@@ -971,12 +2439,12 @@ class Jiraclient(object):
     #   or list of dicts.  Where if the thing is a dict, it might
     #   be keyed on "id", "key", "name" etc.
     #   If the key is "id" we convert "value" to id of value from self.maps
-    self.logger.debug("update issue object: %s %s" % (key,value))
+    self.logger.debug("update issue object: %s %s",key,value)
 
     if not key or not value: return
 
     if not hasattr(issue,key):
-      self.logger.debug("set simple attr: %s %s" % (key,value))
+      self.logger.debug("set simple attr: %s %s",key,value)
       setattr(issue,key,value)
 
     attr = getattr(issue,key)
@@ -999,14 +2467,17 @@ class Jiraclient(object):
       # If we say set issue attr to 10, an int, then we don't have to look it up.
       attribute_id = value
     elif self.maps.has_key(key.lower()):
-      self.logger.debug("update with key value : %s %s" % (key,value))
+      self.logger.debug("update with key value : %s %s",key,value)
       if type(value) is str:
-        self.logger.debug("look at: %s" % self.maps[key.lower()])
+        self.logger.debug("look at: %s",self.maps[key.lower()])
         attribute_map = self.maps[key.lower()]
         attribute_id = attribute_map.find_key(value.lower())
-        self.logger.debug("use id %s for %s" % (attribute_id,value))
+        if not attribute_id and self.refresh_metadata_cache():
+          attribute_map = self.maps[key.lower()]
+          attribute_id = attribute_map.find_key(value.lower())
+        self.logger.debug("use id %s for %s",attribute_id,value)
       else:
-        self.logger.debug("use value for: %s %s" % (key,value))
+        self.logger.debug("use value for: %s %s",key,value)
         setattr(issue,key,value)
         return issue
       if not attribute_id:
@@ -1016,27 +2487,27 @@ class Jiraclient(object):
 
     # Plain string assignment
     if type(attr) is str:
-      self.logger.debug("use str for: %s %s" % (key,value))
+      self.logger.debug("use str for: %s %s",key,value)
       setattr(issue,key,str(value))
 
     # Lists might be lists of strings or lists of dicts
     # 'labels' is the only list of just strings
     if type(attr) is list:
       if key == 'labels':
-        attr.append(str(value))
+        setattr(issue,key,attr + [str(value)])
       else:
         try:
           # remove initial empty value if it's there
           attr.pop(attr.index({'id':None}))
         except Exception: pass
-        self.logger.debug("set dict for %s %s" % (key,[{'id':str(attribute_id)}]))
+        self.logger.debug("set dict for %s %s",key,[{'id':str(attribute_id)}])
         setattr(issue,key,[{'id':str(attribute_id)}])
 
     if type(attr) is dict:
-      self.logger.debug("set dict attr %s %s" % (key,value))
-      item = getattr(issue,key)
+      self.logger.debug("set dict attr %s %s",key,value)
+      item = dict(getattr(issue,key))
       if type(value) is dict:
-        setattr(issue,key,value)
+        item = value
       elif item.has_key('id'):
         if attribute_map:
           # If this attribute is one with a self.maps entry...
@@ -1047,13 +2518,14 @@ class Jiraclient(object):
         item['name'] = str(value)
       elif item.has_key('key'):
         item['key'] = str(value)
+      setattr(issue,key,item)
 
     return issue
 
   def update_issue_from_options(self,issue):
-    self.logger.debug("update issue from options: %s" % issue)
-    for key in issue.__dict__.keys():
-      self.logger.debug("check attr %s" % key)
+    self.logger.debug("update issue from options: %s",issue)
+    for (key,empty) in issue.schema:
+      self.logger.debug("check attr %s",key)
       if hasattr(self.options,key):
         attr = getattr(self.options,key)
         if attr:
@@ -1064,14 +2536,14 @@ class Jiraclient(object):
           for value in values:
             issue = self.update_issue_obj(issue,key,value)
         else:
-          self.logger.debug("options has empty value for: %s" % (key))
+          self.logger.debug("options has empty value for: %s",key)
       else:
-        self.logger.debug("options has no value for: %s" % (key))
-    self.logger.debug("updated issue: %s" % issue)
+        self.logger.debug("options has no value for: %s",key)
+    self.logger.debug("updated issue: %s",issue)
     return issue
 
   def create_issue_obj(self,issuetype,defaults=False,empty=False):
-    self.logger.debug("create issue object (%s)" % (defaults))
+    self.logger.debug("create issue object (%s)",defaults)
 
     # Trigger to parse rc file for issue default values
     if defaults:
@@ -1109,8 +2581,9 @@ class Jiraclient(object):
         itype = self.maps['issuetype'].find_key(issuetype)
         if itype is None:
           self.fatal("Failed to set issue type to '%s', no issue id found in %s" % (issuetype,self.maps['issuetype']))
-        self.logger.debug("set issue type to %s" % (itype))
-        issue.issuetype['id'] = itype
+        self.logger.debug("set issue type to %s",itype)
+        issue.issuetype = {'id': itype}
+        self.get_customfields(self.options.project,itype)
 
     if not issue.project:
       self.fatal("Issue must have a project")
@@ -1148,16 +2621,17 @@ class Jiraclient(object):
     if spent is not None:
       m = time_rx.match(spent)
       if not m:
-        self.logger.warning("Time spent has dubious format: %s: no action taken" % (spent))
+        self.logger.warning("Time spent has dubious format: %s: no action taken",spent)
         return
     remaining = self.options.remaining
     if remaining is not None:
       m = time_rx.match(remaining)
       if not m:
-        self.logger.warning("Time remaining has dubious format: %s: no action taken" % (remaining))
+        self.logger.warning("Time remaining has dubious format: %s: no action taken",remaining)
         return
 
     baseuri = 'rest/api/latest/issue/%s/worklog' % issueID
+    import datetime
     dt_today = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000-0000");
 
     args = None
@@ -1185,19 +2659,21 @@ class Jiraclient(object):
       payload = json.dumps(worklog)
       args = ('post',uri)
 
-    self.logger.debug("Log work: %s %s" % (args,payload))
+    self.logger.debug("Log work: %s %s",args,payload)
     return self.call_api(*args,payload=payload)
 
   def link_issues(self,issueFrom,linkType,issueTo):
-    self.logger.debug("Link %s -> %s -> %s" % (issueFrom,linkType,issueTo))
+    self.logger.debug("Link %s -> %s -> %s",issueFrom,linkType,issueTo)
     uri = 'rest/api/latest/issueLink'
     payload = json.dumps({"type":{"name":linkType},"inwardIssue":{"key":issueFrom},"outwardIssue":{"key":issueTo},"comment":{"body":self.options.comment}})
     return self.call_api('post',uri,payload=payload)
 
   def unlink_issues(self,issueFrom,linkType,issueTo):
-    self.logger.debug("Unlink %s -> %s -> %s" % (issueFrom,linkType,issueTo))
+    self.logger.debug("Unlink %s -> %s -> %s",issueFrom,linkType,issueTo)
     for link in self.get_issue_links(issueFrom):
-      if link["outwardIssue"]["key"] == issueTo and link["type"]["name"].lower() == linkType.lower():
+      # Links point one way or the other, only outward ones have outwardIssue
+      outward = link.get("outwardIssue")
+      if outward and outward["key"] == issueTo and link["type"]["name"].lower() == linkType.lower():
         return self.delete_issue_link(link["id"])
     if linkType == "jira_subtask_link":
       # issueFrom has 'subtask' field, issueTo has 'parent' field.
@@ -1218,7 +2694,7 @@ class Jiraclient(object):
     # +-------+-------------------+---------------------+----------------------+--------------+
     # 4 rows in set (0.00 sec)
     # Must set the subtask link first, then change the issue type of child
-    self.logger.debug("Set subtask link: %s -> %s" % (parent,child))
+    self.logger.debug("Set subtask link: %s -> %s",parent,child)
     self.link_issues(parent,'jira_subtask_link',child)
     # Change issue type to subtask and set parent attribute on child issue
     issue = self.create_issue_obj(empty=True,issuetype='sub-task')
@@ -1231,25 +2707,185 @@ class Jiraclient(object):
     payload = json.dumps({"ignoreEpics":"true","issueKeys":idlist})
     uri = "rest/greenhopper/1.0/epics/%s/add" % epic
     self.call_api('put',uri,payload=payload)
-    self.logger.info("Added issues to epic %s: %s/browse/%s" % (epic, self.get_serverinfo()['baseUrl'], idlist))
+    self.logger.info("Added issues to epic %s: %s/browse/%s",epic,self.server_info['baseUrl'],idlist)
+
+  def run_job(self,func,*args):
+    # Run func in a worker thread.  self.fatal() exits with SystemExit,
+    # which would silently kill a pool thread, so catch it here and let the
+    # main thread decide.
+    try:
+      return (True,func(*args))
+    except SystemExit:
+      return (False,None)
+    except Exception, details:
+      self.logger.error("Unhandled exception in %s: %s",func.__name__,details)
+      return (False,None)
+
+  def imap(self,func,iterable,workers=None):
+    # Like itertools.imap, but func runs on --workers threads.  Results come
+    # back in order, and only a few calls run ahead of the caller, so memory
+    # stays bounded however long iterable is.
+    if workers is None:
+      workers = self.get_int_option('workers',self.workers)
+    workers = max(workers,1)
+    from multiprocessing.pool import ThreadPool
+    args = iter(iterable)
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+      for arg in itertools.islice(args,workers*2):
+        pending.append(pool.apply_async(self.run_job,(func,arg)))
+      while pending:
+        (ok,result) = pending.popleft().get(86400)
+        if not ok:
+          self.fatal("Failed to get results from the Jira server")
+        for arg in itertools.islice(args,1):
+          pending.append(pool.apply_async(self.run_job,(func,arg)))
+        yield result
+    finally:
+      pool.terminate()
+
+  def create_issue_tree(self,nodes):
+    # Create the issues of nodes, and the issues of their children once
+    # their parent's key is known.  Up to --workers batches of siblings are
+    # created at once.  Sets the key of each node, None if creation failed.
+    workers = max(self.get_int_option('workers',self.workers),1)
+    size = self.get_int_option('bulk_size',self.bulk_size)
+    if size <= 0:
+      size = 1
+
+    # Keep self.issues_created in template order, not in the order the
+    # worker threads happened to finish in.
+    start = len(self.issues_created)
+    order = list(nodes)
+    for node in nodes:
+      order.extend(node.children)
+
+    from multiprocessing.pool import ThreadPool
+    import Queue
+    pool = ThreadPool(workers)
+    done = Queue.Queue()
+    pending = [0]
+    def submit(group):
+      def callback(result):
+        done.put((group,result))
+      pending[0] += 1
+      pool.apply_async(self.run_job,(self.create_issues,[ node.issue for node in group ]),callback=callback)
+    def submit_all(group):
+      for n in range(0,len(group),size):
+        submit(group[n:n+size])
+
+    try:
+      submit_all(nodes)
+      while pending[0]:
+        # A timeout keeps the wait interruptible with ^C
+        (group,(ok,keys)) = done.get(True,86400)
+        pending[0] -= 1
+        if not ok:
+          self.fatal("Failed to create issues from template")
+        children = []
+        for (node,key) in zip(group,keys):
+          node.key = key
+          if not node.children: continue
+          if key is None:
+            self.logger.error("Not creating %d subtasks of failed story %r",len(node.children),getattr(node.issue,"summary",None))
+            continue
+          for child in node.children:
+            child.issue = self.update_issue_obj(child.issue,'parent',key)
+          children.extend(node.children)
+        if children:
+          submit_all(children)
+    finally:
+      pool.terminate()
+
+    # Every issue that got a key was created, with the fields it has now
+    self.issues_created[start:] = [ self.clean_issue(node.issue) for node in order if node.key is not None ]
+
+  def template_base(self,epic,issuetype):
+    # An Issue of issuetype with the defaults and the fields it inherits
+    # from epic, which every template item of that type starts from
+    issue = self.create_issue_obj(issuetype=issuetype)
+    customfields = self.maps['customfields'][epic.issuetype['id']]
+    inherited = (customfields.find_key('epic/theme'),customfields.find_key('epic link'))
+    for (k,v) in epic.__dict__.items():
+      if k in ('description','summary','issuetype') or (k.startswith('customfield') and k not in inherited): continue
+      issue = self.update_issue_obj(issue,k,v)
+    return issue
+
+  def template_issue(self,bases,epic,issuetype,item,parent=None):
+    # Make an Issue for a template item, inheriting from epic.  What it
+    # inherits is the same for every item of a type, so it's worked out
+    # once into bases and each item starts from a copy.
+    if issuetype not in bases:
+      bases[issuetype] = self.template_base(epic,issuetype)
+    issue = bases[issuetype].copy()
+    for (k,v) in item.items():
+      issue = self.update_issue_obj(issue,k,v)
+    if parent is not None:
+      issue = self.update_issue_obj(issue,'parent',parent)
+    return issue
+
+  def template_documents(self):
+    # Yield the epics of the template one at a time as they're parsed, so a
+    # template of many epics needn't fit in memory, and the first epic is
+    # created while the rest are still being read.  YAML templates have an
+    # epic per document, NDJSON templates an epic per line.
+    template = self.options.template
+    format = self.options.template_format
+    if format is None:
+      format = 'yaml'
+      if os.path.splitext(template)[1].lower() in ('.ndjson','.jsonl'):
+        format = 'ndjson'
+    if template == "-":
+      fd = sys.stdin
+    else:
+      fd = open(template,'r')
+    try:
+      if format == 'ndjson':
+        for (number,line) in enumerate(iter(fd.readline,''),1):
+          if not line.strip(): continue
+          try:
+            data = json.loads(line)
+          except ValueError, details:
+            self.fatal("Failed to parse NDJSON template line %d: %s" % (number,details))
+          yield unicode_to_str(data)
+      else:
+        import yaml
+        # libyaml's loader is many times faster, if PyYAML was built with it
+        loader = getattr(yaml,'CSafeLoader',yaml.SafeLoader)
+        documents = yaml.load_all(fd,Loader=loader)
+        while True:
+          try:
+            data = documents.next()
+          except StopIteration:
+            break
+          except Exception,details:
+            self.fatal("Failed to parse YAML template: %s" % details)
+          yield data
+    finally:
+      if fd is not sys.stdin:
+        fd.close()
 
   def create_issues_from_template(self):
-    import yaml
     self.logger.debug("Create issues from template")
 
     if not self.options.template == "-" and not os.path.exists(self.options.template):
       self.fatal("No such file: %s" % self.options.template)
 
+    # Epics before a parse error are created, the error stops the rest.
+    project = self.options.project
+    for yamldata in self.template_documents():
+      if yamldata is None:
+        # An empty document, eg. after a trailing ---
+        continue
+      if not isinstance(yamldata,dict):
+        self.fatal("Template epics must be mappings of fields, not: %r" % yamldata)
+      self.options.project = project
+      self.create_epic_from_template(yamldata)
+
+  def create_epic_from_template(self,yamldata):
     # This isn't "real" recursion because as we get deeper the thing we represent
     # goes from Epic to Story to Subtask, which are different datatypes in Jira.
-    try:
-      if self.options.template == "-":
-        yamldata = yaml.load(sys.stdin,Loader=yaml.SafeLoader)
-      else:
-        yamldata = yaml.load(file(self.options.template,"r"),Loader=yaml.SafeLoader)
-    except Exception,details:
-      self.fatal("Failed to parse YAML template: %s" % details)
-
     stories = None
     subtasks = None
     if yamldata.has_key('stories'):
@@ -1257,8 +2893,13 @@ class Jiraclient(object):
     if yamldata.has_key('subtasks'):
       subtasks = yamldata.pop('subtasks')
 
-    # Should we use the rc file for issue defaults?
-    defaults = not self.options.norcfile
+    # Should we use the rc file for issue defaults?  Read them once, for
+    # the epic and all its issues.
+    if not self.options.norcfile:
+      self.read_issue_defaults()
+    # The epic and its issues may be in a project of their own
+    if 'project' in yamldata:
+      self.options.project = str(yamldata.pop('project'))
 
     # First create the "Epic", which might be an actual Epic or some custom
     # issue type that is a duplicate of an Epic.  Create this Epic first so we
@@ -1271,78 +2912,56 @@ class Jiraclient(object):
     if 'subtype' in yamldata.keys():
       subtype = yamldata.pop('subtype').lower()
 
-    epic = self.create_issue_obj(defaults=defaults,issuetype=issuetype)
+    epic = self.create_issue_obj(issuetype=issuetype)
     for (k,v) in yamldata.items():
       epic = self.update_issue_obj(epic,k,v)
+    created = len(self.issues_created)
     eid = self.create_issue(epic)
 
     # Modify the epic we just created to set its own theme
     self.modify_issue(eid,{self.maps['customfields'][epic.issuetype['id']].find_key('epic/theme'):[eid]})
     # Update the epic issue object so that epic/theme is inherited for tasks we're about to create
     epic = self.update_issue_obj(epic,self.maps['customfields'][epic.issuetype['id']].find_key('epic/theme'),[eid])
-
-    # create subtasks for eid, inheriting from epic
+    # and record the epic as it is now, with its theme
+    self.issues_created[created] = self.clean_issue(epic)
+
+    # Build the tree of issues under eid.  Subtasks of eid and its stories
+    # can be created at once, subtasks of each story as soon as the story has
+    # its key.
+    nodes = []
+    bases = {}
     if subtasks:
-      idlist = []
       for subtask in subtasks:
         self.logger.debug("create subtask inheriting from epic")
-        issue = self.create_issue_obj(defaults=defaults,issuetype='sub-task')
-        for (k,v) in epic.__dict__.items():
-          if k in ('description','summary','issuetype') or (k.startswith('customfield') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic/theme') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic link')): continue
-          issue = self.update_issue_obj(issue,k,v)
-        for (k,v) in subtask.items():
-          issue = self.update_issue_obj(issue,k,v)
-        issue = self.update_issue_obj(issue,'parent',eid)
-        stid = self.create_issue(issue)
-        idlist.append(stid)
-
-      # We use the word 'epic' a lot, but we might have made a story with subtasks.
-      if issuetype == 'epic':
-        self.epic_link(idlist,eid)
-
-    # create stories for eid, inheriting from epic
+        issue = self.template_issue(bases,epic,'sub-task',subtask,parent=eid)
+        nodes.append(TemplateNode(issue))
+
     if stories:
-      idlist = []
       for story in stories:
         subtasks = None
         if story.has_key('subtasks'):
           subtasks = story.pop('subtasks')
-
         self.logger.debug("create story inheriting from epic")
-        issue = self.create_issue_obj(defaults=defaults,issuetype=subtype)
-        for (k,v) in epic.__dict__.items():
-          if k in ('description','summary','issuetype') or (k.startswith('customfield') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic/theme') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic link')): continue
-          issue = self.update_issue_obj(issue,k,v)
-        for (k,v) in story.items():
-          issue = self.update_issue_obj(issue,k,v)
-        sid = self.create_issue(issue)
-        idlist.append(sid)
-
+        node = TemplateNode(self.template_issue(bases,epic,subtype,story))
         if subtasks:
           # create subtasks for stories of epic, inheriting from epic
           for subtask in subtasks:
             self.logger.debug("create story subtask inheriting from epic")
-            issue = self.create_issue_obj(defaults=defaults,issuetype='sub-task')
-            for (k,v) in epic.__dict__.items():
-              if k in ('description','summary','issuetype') or (k.startswith('customfield') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic/theme') and \
-                  k != self.maps['customfields'][epic.issuetype['id']].find_key('epic link')): continue
-              issue = self.update_issue_obj(issue,k,v)
-            for (k,v) in subtask.items():
-              issue = self.update_issue_obj(issue,k,v)
-            issue = self.update_issue_obj(issue,'parent',sid)
-            stid = self.create_issue(issue)
-            idlist.append(stid)
-
-      # We use the word 'epic' a lot, but we might have made a story with subtasks.
-      if issuetype == 'epic':
-        self.epic_link(idlist,eid)
-
-    self.logger.info("Created issue %s/browse/%s" % (self.get_serverinfo()['baseUrl'], eid))
+            node.children.append(TemplateNode(self.template_issue(bases,epic,'sub-task',subtask)))
+        nodes.append(node)
+
+    self.create_issue_tree(nodes)
+    idlist = []
+    for node in nodes:
+      if node.key is not None:
+        idlist.append(node.key)
+      idlist.extend([ child.key for child in node.children if child.key is not None ])
+
+    # We use the word 'epic' a lot, but we might have made a story with subtasks.
+    if issuetype == 'epic' and idlist:
+      self.epic_link(idlist,eid)
+
+    self.logger.info("Created issue %s/browse/%s",self.server_info['baseUrl'],eid)
 
   def act_on_existing_issue(self):
 
@@ -1355,7 +2974,7 @@ class Jiraclient(object):
 
     # Display a given issue
     if self.options.display:
-      return self.display_issue(self.options.issueID)
+      return self.display_issue(self.options.issueID,fields=self.options.fields)
 
     # Make one issue a sub-task of another
     if self.options.parent is not None:
@@ -1379,7 +2998,7 @@ class Jiraclient(object):
 
     # Modify existing issue
     if self.options.issueID is not None:
-      i = self.fetch_issue(self.options.issueID)
+      i = self.fetch_issue(self.options.issueID,fields='issuetype')
       # We need to know issue type to have access to custom fields
       try:
         itype = i['fields']['issuetype']['name']
@@ -1388,6 +3007,281 @@ class Jiraclient(object):
       issue = self.create_issue_obj(itype,defaults=False)
       return self.modify_issue(self.options.issueID,issue)
 
+  def spawn(self,options,args=None):
+    # A Jiraclient with its own options that shares our session, connections
+    # and metadata, so an operation run by it makes no requests but its own.
+    child = self.__class__()
+    child.options = options
+    child.args = args or []
+    child.logger = self.logger
+    child.parent = self
+    child.local = self.local
+    child.lock = self.lock
+    child.connection_stats = self.connection_stats
+    child.token = self.token
+    child.cookie = self.cookie
+    child.session = self.session
+    child.serverinfo = self.serverinfo
+    # Maps are shared, the child's project's are used if we have them
+    self.keep_maps()
+    child.global_maps = self.global_maps
+    child.maps = child.empty_maps()
+    child.project_maps = self.project_maps
+    child.transition_maps = self.transition_maps
+    return child
+
+  def adopt(self,child):
+    # Keep what a spawned Jiraclient learned for the next one, its maps
+    # are already in project_maps.
+    if self.serverinfo is None:
+      self.serverinfo = child.serverinfo
+
+  def batch_lines(self):
+    # Numbered lines of the --batch file, skipping blank lines and comments
+    if self.options.batch == '-':
+      fd = sys.stdin
+    else:
+      fd = open(os.path.expanduser(self.options.batch),'r')
+    try:
+      # Not "for line in fd", which reads ahead and would wait for more
+      # input than the next line from a pipe.
+      for (number,line) in enumerate(iter(fd.readline,''),1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+          yield (number,line)
+    finally:
+      if fd is not sys.stdin:
+        fd.close()
+
+  def json_to_args(self,parser,data):
+    # Turn a JSON batch line into command line arguments.  Keys are long
+    # option names or their dest, eg. "epic-link" or "epic_link".
+    options = {}
+    for option in parser.option_list:
+      options[option.dest] = option
+      for name in option._long_opts:
+        options[name[2:]] = option
+    args = []
+    for (key,value) in data.items():
+      if key == 'id': continue
+      option = options.get(key)
+      if option is None:
+        raise ValueError("Unknown option: %s" % key)
+      if option.takes_value():
+        if isinstance(value,unicode):
+          value = value.encode('utf-8')
+        args.extend([option.get_opt_string(),str(value)])
+      elif value:
+        args.append(option.get_opt_string())
+    return args
+
+  def batch_jobs(self,parser):
+    # Parse each batch line into options, which start out as ours, so
+    # options given with --batch apply to every line.
+    for (number,line) in self.batch_lines():
+      result = {'line': number}
+      try:
+        if line.startswith('{'):
+          data = json.loads(line)
+          if not isinstance(data,dict):
+            raise ValueError("Expected a JSON object")
+          if 'id' in data:
+            result['id'] = data['id']
+          args = self.json_to_args(parser,data)
+        else:
+          import shlex
+          args = shlex.split(line)
+        options = copy.deepcopy(self.options)
+        options.batch = None
+        (options,args) = parser.parse_args(args,options)
+      except (ValueError,SystemExit), details:
+        result['ok'] = False
+        result['error'] = str(details)
+        yield (result,None,None)
+        continue
+      yield (result,options,args)
+
+  def batch_job(self,job):
+    (result,options,args) = job
+    if options is None:
+      return result
+    child = self.spawn(options,args)
+    self.output.capture()
+    try:
+      try:
+        value = child.dispatch()
+        result['ok'] = True
+        if value is not None:
+          result['result'] = value
+      except SystemExit, details:
+        result['ok'] = False
+        result['error'] = fatal_message(details)
+      except Exception, details:
+        result['ok'] = False
+        result['error'] = "%s: %s" % (type(details).__name__,details)
+    finally:
+      output = self.output.release()
+    if output:
+      result['output'] = output
+    self.adopt(child)
+    return result
+
+  def run_batch(self):
+    # Run each --batch line as if it were its own jiraclient command, but
+    # with one session, connection pool and set of metadata.  Print one JSON
+    # result per line, in the order of the lines.
+    workers = self.get_int_option('batch_workers',1)
+    parser = self.make_parser(LineParser)
+    stdout = sys.stdout
+    self.output = ThreadOutput(stdout)
+    sys.stdout = self.output
+    (count,failed) = (0,0)
+    try:
+      for result in self.imap(self.batch_job,self.batch_jobs(parser),workers=workers):
+        count += 1
+        if not result['ok']:
+          failed += 1
+        stdout.write(json.dumps(result,default=str) + "\n")
+        stdout.flush()
+    finally:
+      sys.stdout = stdout
+    if failed:
+      self.fatal("%d of %d batch operations failed" % (failed,count))
+
+  def forward(self,given):
+    # Have a running --daemon do what we were asked.  Returns False if
+    # there is no daemon, or it can't do it for us.
+    if not self.options.socket: return False
+    path = os.path.expanduser(self.options.socket)
+    if not os.path.exists(path): return False
+    if '-' in (self.options.batch,self.options.keys,self.options.template):
+      # The daemon can't read our stdin
+      return False
+    if self.options.stats or self.options.stats_file:
+      # The daemon's stats are of every command it ran, not just ours
+      return False
+    import socket
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+      sock.connect(path)
+    except socket.error, details:
+      self.logger.debug("no daemon at %s: %s",path,details)
+      sock.close()
+      return False
+    self.logger.debug("forward to daemon at %s",path)
+    request = {
+      'cwd'    : os.getcwd(),
+      'jiraurl': self.options.jiraurl,
+      'user'   : self.options.user,
+      # Log at our level, not the daemon's
+      'options': dict(given,loglevel=self.options.loglevel),
+      'args'   : self.args,
+    }
+    rfile = sock.makefile('r')
+    code = 0
+    try:
+      sock.sendall(json.dumps(request) + "\n")
+      for line in iter(rfile.readline,''):
+        message = json.loads(line)
+        if 'refused' in message:
+          self.logger.debug("daemon refused: %s",message['refused'])
+          return False
+        if 'out' in message:
+          sys.stdout.write(message['out'].encode('utf-8'))
+        if 'err' in message:
+          sys.stderr.write(message['err'].encode('utf-8'))
+        if 'exit' in message:
+          code = message['exit']
+    finally:
+      rfile.close()
+      sock.close()
+    if code:
+      sys.exit(code)
+    return True
+
+  def serve_request(self,rfile,wfile):
+    # Run one forwarded command, sending what it prints and logs back
+    line = rfile.readline()
+    if not line:
+      # Someone checking that we're running
+      return
+    request = json.loads(line)
+    for name in ('jiraurl','user'):
+      if request.get(name) != getattr(self.options,name):
+        wfile.write(json.dumps({'refused': "%s does not match" % name}) + "\n")
+        return
+    options = copy.deepcopy(self.options)
+    options.daemon = False
+    for (k,v) in unicode_to_str(request['options']).items():
+      setattr(options,k,v)
+    child = self.spawn(options,unicode_to_str(request['args']))
+
+    # The daemon serves one command at a time, so it can borrow stdout,
+    # the log handlers and working directory for the duration.
+    (stdout,handlers,level) = (sys.stdout,self.logger.handlers,self.logger.level)
+    handler = logging.StreamHandler(MessageStream(wfile,'err'))
+    handler.setFormatter(handlers[0].formatter)
+    sys.stdout = MessageStream(wfile,'out')
+    self.logger.handlers = [handler]
+    self.logger.setLevel(logging._levelNames[options.loglevel])
+    cwd = os.getcwd()
+    code = 0
+    try:
+      try:
+        os.chdir(request['cwd'])
+        child.dispatch()
+      except SystemExit, details:
+        code = details.code
+      except Exception, details:
+        self.logger.error("Unhandled exception: %s",details)
+        code = 1
+    finally:
+      sys.stdout = stdout
+      self.logger.handlers = handlers
+      self.logger.setLevel(level)
+      os.chdir(cwd)
+    self.adopt(child)
+    wfile.write(json.dumps({'exit': code}) + "\n")
+
+  def serve(self):
+    # Run as --daemon, until interrupted
+    import socket
+    import SocketServer
+    client = self
+    class DaemonHandler(SocketServer.StreamRequestHandler):
+      # Buffer replies, the messages of one print are flushed together
+      wbufsize = 65536
+      def handle(self):
+        try:
+          client.serve_request(self.rfile,self.wfile)
+        except socket.error, details:
+          client.logger.warning("Lost daemon client: %s",details)
+    path = os.path.expanduser(self.options.socket)
+    if os.path.exists(path):
+      sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      try:
+        sock.connect(path)
+        sock.close()
+        self.fatal("A daemon is already running on %s" % path)
+      except socket.error:
+        # Left behind by a daemon that died
+        os.unlink(path)
+    # Nobody else may talk to the daemon, it acts as us
+    umask = os.umask(int("077",8))
+    try:
+      server = SocketServer.UnixStreamServer(path,DaemonHandler)
+    finally:
+      os.umask(umask)
+    try:
+      # Get the metadata now, so the first command needn't
+      if self.options.project is not None:
+        self.update_maps_from_jiraserver()
+      self.logger.info("Serving jiraclient commands on %s",path)
+      server.serve_forever()
+    finally:
+      server.server_close()
+      os.unlink(path)
+
   def setup(self):
 
     self.parse_args()
@@ -1397,12 +3291,33 @@ class Jiraclient(object):
 
   def run(self):
 
-    self.setup()
-
+    self.parse_args()
     if self.options.version:
       self.print_version()
       return
 
+    given = self.given_options()
+    self.prepare_logger()
+    self.read_config()
+
+    if self.options.daemon:
+      self.check_auth()
+      return self.serve()
+
+    if self.forward(given):
+      return
+
+    self.check_auth()
+
+    try:
+      return self.dispatch()
+    finally:
+      self.logger.debug("Connections: %(connections)d opened, %(reused)d reused for %(requests)d requests",self.get_connection_stats())
+      self.report_stats()
+
+  def dispatch(self):
+    # Do what the options ask for
+
     # Notify the user if noop is on
     if self.options.noop:
       self.logger.info("NOOPMODE: API will not be called")
@@ -1413,12 +3328,20 @@ class Jiraclient(object):
     if not self.options.jiraurl:
       self.fatal("Please specify the Jira URL")
 
+    # Run many operations from a file
+    if self.options.batch is not None:
+      return self.run_batch()
+
+    # Move many issues through the workflow
+    if self.options.transition is not None:
+      return self.run_transitions()
+
     # Run a named Jira API call and return
     if self.options.api is not None:
       # Set payload
       payload = None
       if self.options.jsondata is not None:
-        self.logger.debug("read json data %s" % self.options.jsondata)
+        self.logger.debug("read json data %s",self.options.jsondata)
         if self.options.jsondata.startswith("{"):
           payload = json.dumps(json.loads(self.options.jsondata))
         else:
@@ -1438,10 +3361,31 @@ class Jiraclient(object):
             self.fatal("API error: file not found: %s" % self.options.jsondata)
       # Send payload with method
       try:
-        response = self.call_api(self.options.method.lower(),self.options.api,payload=payload)
-        print json.dumps(response)
+        if self.options.stream:
+          response = self.call_api(self.options.method.lower(),self.options.api,payload=payload,full=True)
+        else:
+          response = self.call_api(self.options.method.lower(),self.options.api,payload=payload)
       except Exception, details:
         self.fatal("API error: bad method: %s" % details)
+      if self.options.stream and type(response).__name__ == 'Response':
+        # Pass the body through as it arrives
+        body = response.body_stream()
+        try:
+          while True:
+            data = body.read(65536)
+            if not data: break
+            sys.stdout.write(data)
+        finally:
+          body.close()
+        sys.stdout.write("\n")
+      else:
+        print json.dumps(response)
+      return
+
+    # Search for issues
+    if self.options.jql is not None:
+      for issue in self.search(self.options.jql,fields=self.options.fields):
+        print json.dumps(issue)
       return
 
     # Link two existing IDs
@@ -5,17 +5,59 @@ import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
 
+class WorklogClient(jiraclient.Jiraclient):
+    # A Jiraclient that also takes the options of the report
+    def make_parser(self,*args,**kwargs):
+        parser = jiraclient.Jiraclient.make_parser(self,*args,**kwargs)
+        parser.add_option(
+            "--worklog-times",
+            action="store_true",
+            dest="worklog_times",
+            help="Also report when each worklog started and the seconds spent",
+            default=False,
+        )
+        return parser
+
 class WorklogReport(object):
     def __init__(self):
-        self.client = jiraclient.Jiraclient()
+        self.client = WorklogClient()
         self.client.setup()
 
+    def issue_keys(self):
+        # Issues given with --issue, which may be a comma separated list, as
+        # arguments, or matching --jql
+        options = self.client.options
+        if options.issueID:
+            for key in options.issueID.split(','):
+                yield key
+        for key in self.client.args:
+            yield key
+        if options.jql:
+            for issue in self.client.search(options.jql,fields='key'):
+                yield issue['key']
+
+    def worklogs(self,issueID):
+        # An issue we can't read, eg. one deleted since the search, is
+        # skipped rather than ending the report
+        try:
+            return (issueID,self.client.get_worklogs(issueID))
+        except SystemExit, details:
+            self.client.logger.warning("Skipped worklogs of %s: %s",issueID,jiraclient.fatal_message(details))
+            return (issueID,[])
+
     def run(self):
-        issueID = self.client.options.issueID
-        uri = 'rest/api/latest/issue/%s' % issueID
-        result = self.client.call_api('get',uri)
-        for log in result['fields']['worklog']['worklogs']:
-          print "%s %s %s" % (issueID,log['author']['name'],log['comment'])
+        # Worklogs of several issues are fetched at once, and printed as
+        # each issue's arrive.  Lines are key, author and comment, unless
+        # --worklog-times asks for the start and seconds spent too.
+        times = self.client.options.worklog_times
+        for (issueID,worklogs) in self.client.imap(self.worklogs,self.issue_keys()):
+            for log in worklogs:
+                if times:
+                    comment = ' '.join(log.get('comment','').split())
+                    line = u"%s %s %s %s %s" % (issueID,log['author']['name'],log['started'],log['timeSpentSeconds'],comment)
+                else:
+                    line = u"%s %s %s" % (issueID,log['author']['name'],log.get('comment',''))
+                print line.encode('utf-8')
 
 def main():
     A = WorklogReport()
@@ -0,0 +1,90 @@
+# Compare the cost of building issue payloads with the Issue as it was,
+# with placeholder defaults cleaned out by clean_issue(), and as it is,
+# keeping only the fields that were set.  Also times repr(), which debug
+# logging calls for every update of an issue.
+#
+#   python test/benchIssue.py
+
+import json
+import os
+import sys
+import timeit
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+
+import jiraclient
+
+class LegacyIssue(object):
+  # The Issue as it was, every field set to a placeholder
+  def __init__(self):
+    self.summary      = ''
+    self.environment  = ''
+    self.description  = ''
+    self.duedate      = ''
+    self.project      = { 'id': None }
+    self.issuetype    = { 'id': None }
+    self.assignee     = { 'name': None }
+    self.priority     = { 'id': None }
+    self.parent       = { 'key': None }
+    self.timetracking = { 'originalEstimate': None }
+    self.labels       = []
+    self.versions     = [ { 'id': None } ]
+    self.fixVersions  = [ { 'id': None } ]
+    self.components   = [ { 'id': None } ]
+
+  def __repr__(self):
+    text = "%s(" % (self.__class__.__name__)
+    for attr in dir(self):
+      if attr.startswith('_'): continue
+      a = getattr(self,attr)
+      if callable(a): continue
+      text += "%s=%r," % (attr,a)
+    text += ")"
+    return text
+
+def legacy_clean_issue(issue):
+  issue = issue.__dict__
+  for k,v in issue.items():
+    if not v: issue.pop(k)
+    if v == {"id":None}: issue.pop(k)
+    if v == {"name":None}: issue.pop(k)
+    if v == {"key":None}: issue.pop(k)
+    if v == {"originalEstimate":None}: issue.pop(k)
+    if v == [{"id":None}]: issue.pop(k)
+  return issue
+
+def fill(issue,n):
+  # Set the fields a typical template story has
+  issue.summary = "Story %d" % n
+  issue.description = "Story %d description" % n
+  issue.project = {'id': '10001'}
+  issue.issuetype = {'id': '7'}
+  issue.assignee = {'name': 'jirauser'}
+  issue.priority = {'id': '6'}
+  issue.components = [{'id': '10111'}]
+  issue.fixVersions = [{'id': '10020'}]
+  issue.customfield_10010 = ['INFOSYS-1']
+  return issue
+
+def legacy_payloads(count):
+  return json.dumps({"issueUpdates":[ {"fields":legacy_clean_issue(fill(LegacyIssue(),n))} for n in range(count) ]})
+
+def payloads(count):
+  return json.dumps({"issueUpdates":[ {"fields":fill(jiraclient.Issue(),n).fields()} for n in range(count) ]})
+
+def main():
+  count = 10000
+  assert json.loads(legacy_payloads(10)) == json.loads(payloads(10))
+  print "Building %d issue payloads (ms):" % count
+  print "  placeholders and clean_issue: %8.1f" % (min(timeit.Timer(lambda: legacy_payloads(count)).repeat(3,1)) * 1000)
+  print "  set fields and fields():      %8.1f" % (min(timeit.Timer(lambda: payloads(count)).repeat(3,1)) * 1000)
+  number = 10000
+  legacy = fill(LegacyIssue(),1)
+  issue = fill(jiraclient.Issue(),1)
+  print "repr() of an issue (usec):"
+  print "  dir() walk:                   %8.1f" % (timeit.Timer(lambda: repr(legacy)).timeit(number) / number * 1e6)
+  print "  set fields:                   %8.1f" % (timeit.Timer(lambda: repr(issue)).timeit(number) / number * 1e6)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,128 @@
+# End-to-end benchmarks of jiraclient against the stand-in Jira server in
+# test/fakejira.py.  For each workload, print the requests jiraclient made,
+# the wall time it took and its peak memory.  jiraclient runs in a process
+# of its own for each workload, so that the memory is its own.
+#
+#   python test/benchJira.py [--latency SECONDS] [workload ...]
+#
+# Workloads: create, template, epics, search, worklogs
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import fakejira
+
+def template(path,stories=20,subtasks=24,epics=1):
+  # Epics of stories with subtasks, epics * (1 + stories * (1 + subtasks))
+  # issues.  An .ndjson path gets one epic per line, others YAML documents.
+  fd = open(path,'w')
+  for e in range(epics):
+    epic = {
+      'summary': "Benchmark epic %d" % e, 'epic name': "Benchmark %d" % e, 'description': "Epic description",
+      'stories': [ {'summary': "Story %d" % s, 'description': "Story %d description" % s,
+        'subtasks': [ {'summary': "Story %d subtask %d" % (s,t), 'timetracking': '1h'} for t in range(subtasks) ]}
+        for s in range(stories) ],
+    }
+    if path.endswith('.ndjson'):
+      fd.write(json.dumps(epic) + "\n")
+      continue
+    if e:
+      fd.write("---\n")
+    fd.write("summary: %(summary)s\nepic name: %(epic name)s\ndescription: %(description)s\nstories:\n" % epic)
+    for story in epic['stories']:
+      fd.write("  - summary: %(summary)s\n    description: %(description)s\n    subtasks:\n" % story)
+      for subtask in story['subtasks']:
+        fd.write("      - summary: %(summary)s\n        timetracking: %(timetracking)s\n" % subtask)
+  fd.close()
+
+# prepare_<workload>(jira,home) adds what the workload needs to the server
+# and returns the command to run.
+def prepare_create(jira,home):
+  return ['jiraclient','-T','task','-S','Benchmark task']
+
+def prepare_template(jira,home):
+  path = os.path.join(home,'template.yaml')
+  template(path)
+  return ['jiraclient','--template',path]
+
+def prepare_epics(jira,home):
+  path = os.path.join(home,'template.yaml')
+  template(path,epics=10)
+  return ['jiraclient','--template',path]
+
+def prepare_search(jira,home):
+  jira.add_issues(5000)
+  return ['jiraclient','--jql','project = INFOSYS','--fields','summary,status']
+
+def prepare_worklogs(jira,home):
+  jira.add_issues(500,worklogs=20)
+  return ['worklogs','--jql','project = INFOSYS']
+
+workloads = ('create','template','epics','search','worklogs')
+
+def client(command,args):
+  # Run in the workload's own process, report to the parent on stdout
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull,'w')
+  sys.argv = [command] + args
+  start = time.time()
+  if command == 'worklogs':
+    import worklogs
+    worklogs.WorklogReport().run()
+  else:
+    import jiraclient
+    jiraclient.Jiraclient().run()
+  elapsed = time.time() - start
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  stdout.write(json.dumps({'wall': elapsed, 'maxrss': maxrss}) + "\n")
+
+def run(jira,name):
+  home = tempfile.mkdtemp()
+  try:
+    command = globals()['prepare_%s' % name](jira,home)
+    # Metadata and session are fetched the first time, as a new user would
+    jira.reset_counts()
+    args = command[1:] + jira.client_args(home)
+    proc = subprocess.Popen([sys.executable,__file__,'--client',command[0]] + args,
+      stdout=subprocess.PIPE,stderr=open(os.devnull,'w'))
+    (out,err) = proc.communicate()
+    if proc.returncode != 0:
+      raise RuntimeError("%s workload failed" % name)
+    result = json.loads(out)
+    result.update(requests=jira.requests,bytes=jira.bytes,counts=jira.counts)
+    return result
+  finally:
+    shutil.rmtree(home)
+
+def main():
+  if len(sys.argv) > 2 and sys.argv[1] == '--client':
+    return client(sys.argv[2],sys.argv[3:])
+  parser = OptionParser("%prog [--latency SECONDS] [workload ...]")
+  parser.add_option("--latency",type="float",default=0.005,help="Seconds the server takes per request")
+  parser.add_option("--verbose",action="store_true",default=False,help="Show requests per endpoint")
+  (options,args) = parser.parse_args()
+  print "%-10s %9s %10s %9s %11s" % ("workload","requests","kbytes","wall s","maxrss kB")
+  for name in args or workloads:
+    jira = fakejira.FakeJira(latency=options.latency).start()
+    try:
+      result = run(jira,name)
+    finally:
+      jira.stop()
+    print "%-10s %9d %10d %9.2f %11d" % (name,result['requests'],result['bytes'] / 1024,result['wall'],result['maxrss'])
+    if options.verbose:
+      for (endpoint,count) in sorted(result['counts'].items()):
+        print "    %6d %s" % (count,endpoint)
+
+if __name__ == "__main__":
+  main()
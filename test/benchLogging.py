@@ -0,0 +1,60 @@
+# Compare the per-record cost of log formatting before and after the
+# IndentFormatter rewrite, and of eager vs. lazy message formatting when
+# DEBUG is off.
+#
+#   python test/benchLogging.py
+
+import inspect
+import logging
+import os
+import sys
+import timeit
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+
+import jiraclient
+
+class LegacyIndentFormatter(logging.Formatter):
+    # The IndentFormatter as it was, calling inspect.stack() per record
+    def __init__( self, fmt=None, datefmt=None ):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.baseline = len(inspect.stack())
+    def format( self, rec ):
+        stack = inspect.stack()
+        rec.indent = ' '*(len(stack)-self.baseline)
+        rec.function = stack[min(8,len(stack)-1)][3]
+        out = logging.Formatter.format(self, rec)
+        del rec.indent; del rec.function
+        return out
+
+fmt = "%(asctime)s %(name)s[%(process)d]: %(levelname)s: %(indent)s %(message)s"
+datefmt = "%b %d %H:%M:%S"
+
+def per_record(formatter,number):
+  record = logging.LogRecord("jiraclient",logging.DEBUG,__file__,1,"update issue %s",(jiraclient.Issue(),),None)
+  seconds = timeit.Timer(lambda: formatter.format(record)).timeit(number)
+  return seconds / number * 1e6
+
+def per_call(func,number):
+  return timeit.Timer(func).timeit(number) / number * 1e6
+
+def main():
+  number = 2000
+  print "Formatting one record (usec):"
+  print "  inspect.stack() formatter:   %8.1f" % per_record(LegacyIndentFormatter(fmt,datefmt),number)
+  print "  IndentFormatter, indent:     %8.1f" % per_record(jiraclient.IndentFormatter(fmt,datefmt,indent=True),number)
+  print "  IndentFormatter, no indent:  %8.1f" % per_record(jiraclient.IndentFormatter(fmt,datefmt),number)
+
+  logger = logging.getLogger("benchLogging")
+  logger.addHandler(logging.StreamHandler())
+  logger.setLevel(logging.INFO)
+  issue = jiraclient.Issue()
+  maps = dict([ (str(n),"version %d" % n) for n in range(1000) ])
+  number = 20000
+  print "Debug call with DEBUG off (usec):"
+  print "  eager %% formatting:          %8.2f" % per_call(lambda: logger.debug("update issue %s maps %s" % (issue,maps)),number/10)
+  print "  lazy arguments:              %8.2f" % per_call(lambda: logger.debug("update issue %s maps %s",issue,maps),number)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,47 @@
+# Compare SearchableDict.find_key() against the linear scan it replaced, on
+# maps the size of a long lived project's versions or components.
+#
+#   python test/benchSearchableDict.py
+
+import os
+import sys
+import timeit
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+
+import jiraclient
+
+def linear_find_key(dic,val):
+  # SearchableDict.find_key() as it was
+  for k, v in dic.iteritems():
+    if v == val:
+      return k
+    if isinstance(v,dict):
+      if v['name'] == val:
+        return k
+  else:
+    return None
+
+def main():
+  number = 2000
+  print "find_key() per lookup (usec):"
+  print "%8s %12s %12s" % ("entries","linear scan","index")
+  for size in (10,100,1000,5000):
+    versions = jiraclient.SearchableDict()
+    for n in range(size):
+      versions[str(10000+n)] = "sprint %d" % n
+    # Look for names spread over the map, and one that isn't there
+    names = [ "sprint %d" % n for n in range(0,size,max(size/10,1)) ] + [ "no such version" ]
+    def linear():
+      for name in names:
+        linear_find_key(versions,name)
+    def indexed():
+      for name in names:
+        versions.find_key(name)
+    linear_usec = timeit.Timer(linear).timeit(number/10) / (number/10) / len(names) * 1e6
+    index_usec = timeit.Timer(indexed).timeit(number) / number / len(names) * 1e6
+    print "%8d %12.2f %12.2f" % (size,linear_usec,index_usec)
+
+if __name__ == "__main__":
+  main()
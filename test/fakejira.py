@@ -0,0 +1,322 @@
+
+# A stand-in Jira server for benchmarks and tests that need a real HTTP
+# conversation.  It speaks enough of the REST API for jiraclient: sessions,
+# server info, project metadata, createmeta, issues (single and bulk),
+# search, comments, worklogs, transitions, issue links and epics.  Every
+# request can be delayed by latency seconds to stand in for a remote server.
+#
+#   jira = FakeJira(latency=0.01)
+#   jira.start()
+#   jira.add_issues(1000,worklogs=3)
+#   ... point jiraclient at jira.url ...
+#   print jira.requests, jira.counts
+#   jira.stop()
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import re
+import threading
+import time
+import urlparse
+
+# Metadata of the project, named for the project in test/data/jiraclientrc-001
+project = {'id': '10001', 'key': 'INFOSYS'}
+issuetypes = [
+  {'id': '6', 'name': 'Epic', 'subtask': False},
+  {'id': '7', 'name': 'Story', 'subtask': False},
+  {'id': '3', 'name': 'Task', 'subtask': False},
+  {'id': '5', 'name': 'Sub-task', 'subtask': True},
+]
+customfields = {
+  'customfield_10010': {'name': 'Epic/Theme'},
+  'customfield_10011': {'name': 'Epic Name'},
+  'customfield_10012': {'name': 'Epic Link'},
+  'customfield_10020': {'name': 'IT Service', 'allowedValues': [{'id': '1', 'value': 'Other'}]},
+}
+versions = [{'id': '10020', 'name': 'Backlog'}]
+components = [{'id': '10111', 'name': 'CSA'}]
+priorities = [{'id': '6', 'name': 'Normal'}, {'id': '2', 'name': 'Critical'}]
+resolutions = [{'id': '1', 'name': 'Fixed'}, {'id': '0', 'name': 'Complete'}]
+transitions = [
+  {'id': '11', 'name': 'Start Progress', 'to': {'id': '3', 'name': 'In Progress'}},
+  {'id': '21', 'name': 'Resolve Issue', 'to': {'id': '5', 'name': 'Resolved'}},
+]
+
+class FakeJiraHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers go out a write at a time, don't let them wait on delayed ACKs
+  disable_nagle_algorithm = True
+
+  def log_message(self,*args):
+    pass
+
+  def do_request(self):
+    url = urlparse.urlparse(self.path)
+    query = dict(urlparse.parse_qsl(url.query))
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else ''
+    payload = json.loads(body) if body else None
+    jira = self.server.jira
+    time.sleep(jira.latency)
+    (status,data,headers) = jira.handle(self.command,url.path,query,payload,self.headers)
+    data = json.dumps(data) if data is not None else ''
+    self.send_response(status)
+    self.send_header('Content-Type','application/json')
+    self.send_header('Content-Length',str(len(data)))
+    for (k,v) in headers.items():
+      self.send_header(k,v)
+    self.end_headers()
+    self.wfile.write(data)
+    jira.count_bytes(len(data))
+
+  do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+class FakeJiraServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class FakeJira(object):
+
+  def __init__(self,latency=0,page_size=100):
+    self.latency = latency
+    # The most issues a search returns at once, whatever was asked for
+    self.page_size = page_size
+    self.lock = threading.Lock()
+    self.issues = {}
+    self.order = []
+    self.links = {}
+    self.epics = {}
+    self.next_id = 10000
+    # Issue keys whose POSTs, eg. transitions and comments, are refused
+    # with an HTTP status, eg. 403
+    self.refused = {}
+    # Sessions made, those numbered below valid_from have expired
+    self.sessions = 0
+    self.valid_from = 1
+    self.reset_counts()
+
+  def start(self):
+    self.server = FakeJiraServer(('127.0.0.1',0),FakeJiraHandler)
+    self.server.jira = self
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def client_args(self,home):
+    # Command line for a jiraclient talking to us, keeping its session and
+    # metadata cache in the directory home
+    rcfile = os.path.join(home,'jiraclientrc')
+    if not os.path.exists(rcfile):
+      fd = open(rcfile,'w')
+      fd.write("[jiraclient]\n[issues]\nproject = INFOSYS\npriority = normal\nassignee = jirauser\ncomponents = CSA\nfixVersions = Backlog\n")
+      fd.close()
+      os.chmod(rcfile,int("600",8))
+    return ['--config',rcfile,'--sessionfile',os.path.join(home,'session'),
+      '--metadata-cache',os.path.join(home,'metadata'),'--socket','',
+      '--jiraurl',self.url,'-u','jirauser','-p','jirauser']
+
+  def expire_sessions(self):
+    # Refuse every session made so far, as if Jira had restarted
+    self.valid_from = self.sessions + 1
+
+  def reset_counts(self):
+    self.requests = 0
+    self.bytes = 0
+    # Requests by method and path, with issue keys and ids replaced by {}
+    self.counts = {}
+
+  def count(self,method,path):
+    path = re.sub(r'/[A-Z][A-Z0-9]*-\d+','/{key}',path)
+    path = re.sub(r'/\d+(?=/|$)','/{id}',path)
+    name = "%s %s" % (method,path)
+    self.lock.acquire()
+    try:
+      self.requests += 1
+      self.counts[name] = self.counts.get(name,0) + 1
+    finally:
+      self.lock.release()
+
+  def count_bytes(self,n):
+    self.lock.acquire()
+    self.bytes += n
+    self.lock.release()
+
+  def new_issue(self,fields):
+    self.lock.acquire()
+    try:
+      self.next_id += 1
+      n = len(self.order) + 1
+      key = "%s-%d" % (project['key'],n)
+      issue = {
+        'id': str(self.next_id),
+        'key': key,
+        'self': "%s/rest/api/2/issue/%d" % (self.url,self.next_id),
+        'fields': dict(fields,status={'id': '1', 'name': 'Open'},issuelinks=[],comment={'comments': []}),
+        'worklogs': [],
+      }
+      self.issues[key] = issue
+      self.order.append(key)
+    finally:
+      self.lock.release()
+    return issue
+
+  def add_issues(self,count,worklogs=0,issuetype='3'):
+    # Fill the project with issues for searches and worklog reports
+    keys = []
+    for n in range(count):
+      issue = self.new_issue({
+        'summary': "Issue %d" % n,
+        'description': "Description of issue %d " % n * 10,
+        'issuetype': {'id': issuetype},
+        'project': {'id': project['id']},
+      })
+      for w in range(worklogs):
+        issue['worklogs'].append({
+          'id': str(w),
+          'author': {'name': 'jirauser'},
+          'started': '2020-01-%02dT09:00:00.000+0000' % (w % 28 + 1),
+          'timeSpentSeconds': 3600,
+          'comment': "Work %d on %s" % (w,issue['key']),
+        })
+      keys.append(issue['key'])
+    return keys
+
+  def view(self,issue,query):
+    # An issue as GET issue returns it, with only the fields asked for
+    fields = issue['fields']
+    if query.get('fields'):
+      names = query['fields'].split(',')
+      fields = dict([ (k,v) for (k,v) in fields.items() if k in names ])
+    return {'id': issue['id'], 'key': issue['key'], 'self': issue['self'], 'fields': fields}
+
+  def page(self,items,query,name):
+    start = int(query.get('startAt',0))
+    size = min(int(query.get('maxResults',50)),self.page_size)
+    return {'startAt': start, 'maxResults': size, 'total': len(items), name: items[start:start+size]}
+
+  def handle(self,method,path,query,payload,headers):
+    # Returns (status,data,headers) for a request
+    self.count(method,path)
+    if not headers.get('Authorization'):
+      session = re.search(r'JSESSIONID=FAKE(\d+)',headers.get('Cookie') or '')
+      if session is None or int(session.group(1)) < self.valid_from:
+        return (401,{'errorMessages': ['Not logged in']},{})
+    if path == '/rest/auth/latest/session':
+      self.lock.acquire()
+      self.sessions += 1
+      session = self.sessions
+      self.lock.release()
+      return (200,{'name': 'jirauser'},{'Set-Cookie': 'JSESSIONID=FAKE%d; Path=/' % session})
+    api = '/rest/api/latest/'
+    if path.startswith('/rest/greenhopper/1.0/epics/'):
+      epic = path.split('/')[5]
+      self.epics.setdefault(epic,[]).extend(payload['issueKeys'])
+      return (204,None,{})
+    if not path.startswith(api):
+      return (404,{'errorMessages': ['No such resource']},{})
+    parts = path[len(api):].strip('/').split('/')
+
+    if parts == ['serverInfo']:
+      return (200,{'baseUrl': self.url, 'version': '7.6.0', 'versionNumbers': [7,6,0]},{})
+    if parts[0] == 'project' and len(parts) == 2:
+      return (200,project,{})
+    if parts[0] == 'project' and parts[2] == 'versions':
+      return (200,versions,{})
+    if parts[0] == 'project' and parts[2] == 'components':
+      return (200,components,{})
+    if parts == ['priority']:
+      return (200,priorities,{})
+    if parts == ['resolution']:
+      return (200,resolutions,{})
+    if parts == ['search']:
+      # Only "key in (...)" is understood, any other JQL finds every issue
+      keys = self.order
+      m = re.match(r'key in \((.*)\)$',query.get('jql',''))
+      if m:
+        keys = [ key.strip().upper() for key in m.group(1).split(',') ]
+        missing = [ key for key in keys if key not in self.issues ]
+        if missing and query.get('validateQuery') != 'false':
+          return (400,{'errorMessages': ["An issue with key '%s' does not exist" % missing[0]]},{})
+        keys = [ key for key in keys if key in self.issues ]
+      issues = [ self.view(self.issues[key],query) for key in keys ]
+      return (200,self.page(issues,query,'issues'),{})
+    if parts == ['issue','createmeta']:
+      types = issuetypes
+      if query.get('issuetypeIds'):
+        types = [ t for t in types if t['id'] in query['issuetypeIds'].split(',') ]
+      types = [ dict(t) for t in types ]
+      if query.get('expand'):
+        for t in types:
+          t['fields'] = dict(customfields)
+          if t['id'] != '6':
+            del t['fields']['customfield_10011']
+      return (200,{'projects': [dict(project,issuetypes=types)]},{})
+    if parts == ['issue'] and method == 'POST':
+      issue = self.new_issue(payload['fields'])
+      return (201,{'id': issue['id'], 'key': issue['key'], 'self': issue['self']},{})
+    if parts == ['issue','bulk'] and method == 'POST':
+      created = [ self.new_issue(update['fields']) for update in payload['issueUpdates'] ]
+      return (201,{'issues': [ {'id': i['id'], 'key': i['key'], 'self': i['self']} for i in created ], 'errors': []},{})
+    if parts[0] == 'issueLink':
+      if method == 'POST':
+        (inward,outward) = (payload['inwardIssue']['key'],payload['outwardIssue']['key'])
+        self.lock.acquire()
+        self.next_id += 1
+        link = {'id': str(self.next_id), 'type': payload['type'], 'outwardIssue': {'key': outward}}
+        self.lock.release()
+        self.links[link['id']] = inward
+        self.issues[inward]['fields']['issuelinks'].append(link)
+        self.issues[outward]['fields']['issuelinks'].append({'id': link['id'], 'type': payload['type'], 'inwardIssue': {'key': inward}})
+        return (201,None,{})
+      if method == 'DELETE':
+        for issue in self.issues.values():
+          issue['fields']['issuelinks'] = [ l for l in issue['fields']['issuelinks'] if l['id'] != parts[1] ]
+        return (204,None,{})
+
+    if parts[0] == 'issue' and len(parts) >= 2:
+      issue = self.issues.get(parts[1])
+      if issue is None:
+        return (404,{'errorMessages': ['Issue Does Not Exist']},{})
+      if method == 'POST' and issue['key'] in self.refused:
+        status = self.refused[issue['key']]
+        return (status,{'errorMessages': ['Refused with %d' % status]},{})
+      if len(parts) == 2:
+        if method == 'GET':
+          return (200,self.view(issue,query),{})
+        if method == 'PUT':
+          issue['fields'].update(payload.get('fields',{}))
+          return (204,None,{})
+        if method == 'DELETE':
+          del self.issues[issue['key']]
+          self.order.remove(issue['key'])
+          return (204,None,{})
+      if parts[2] == 'comment' and method == 'POST':
+        comment = {'id': str(len(issue['fields']['comment']['comments'])), 'body': payload['body']}
+        issue['fields']['comment']['comments'].append(comment)
+        return (201,comment,{})
+      if parts[2] == 'worklog':
+        if method == 'POST':
+          issue['worklogs'].append(dict(payload,id=str(len(issue['worklogs'])),author={'name': 'jirauser'}))
+          return (201,issue['worklogs'][-1],{})
+        return (200,self.page(issue['worklogs'],query,'worklogs'),{})
+      if parts[2] == 'transitions':
+        # An issue can't transition to the status it has
+        available = [ t for t in transitions if t['to']['id'] != issue['fields']['status']['id'] ]
+        if method == 'POST':
+          target = [ t for t in available if t['id'] == str(payload['transition']['id']) ]
+          if not target:
+            return (400,{'errorMessages': ['No such transition']},{})
+          issue['fields']['status'] = target[0]['to']
+          if payload.get('fields',{}).get('resolution'):
+            issue['fields']['resolution'] = payload['fields']['resolution']
+          return (204,None,{})
+        return (200,{'transitions': available},{})
+    return (404,{'errorMessages': ['No such resource']},{})
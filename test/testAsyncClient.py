@@ -0,0 +1,88 @@
+
+import pprint
+import sys
+import os
+import time
+import unittest
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+
+import jiraclient
+import asyncclient
+
+pp = pprint.PrettyPrinter(depth=4,stream=sys.stdout)
+
+class TestUnit(unittest.TestCase):
+
+  def setUp(self):
+    self.c = jiraclient.Jiraclient()
+    self.c.parse_args()
+    self.c.options.config = "./test/data/jiraclientrc-001"
+    self.c.options.sessionfile = "./test/data/jira-session"
+    self.c.options.loglevel = "DEBUG"
+    self.c.prepare_logger()
+    self.c.read_config()
+    self.c.options.noop = True
+    self.c.options.user = 'jirauser'
+    self.c.options.password = 'jirauser'
+    self.client = asyncclient.AsyncJiraclient(self.c,workers=4)
+
+  def tearDown(self):
+    self.client.close()
+
+  def testOperations(self):
+    self.c.options.project = "INFOSYS"
+    issue = self.c.create_issue_obj('task')
+    issue.summary = 'Async'
+    futures = [ self.client.create_issue(issue) for n in range(10) ]
+    assert asyncclient.gather(futures) == ['NOOP'] * 10
+    future = self.client.add_comment('INFOSYS-1','Async')
+    assert future.result() == {}
+    self.assertRaises(AttributeError,getattr,self.client,'run_batch')
+
+  def testOptions(self):
+    # log_work() takes what to log from options
+    future = self.client.log_work('INFOSYS-1',options={'worklog': 'Async', 'timespent': '1h'})
+    future.result()
+    assert self.c.options.worklog is None
+    # Failures are raised by result()
+    future = self.client.call_api('get','rest/api/latest/serverInfo',options={'noop': False, 'jiraurl': 'http://127.0.0.1:1', 'retries': 0})
+    assert isinstance(future.exception(),asyncclient.JiraError)
+    self.assertRaises(asyncclient.JiraError,future.result)
+
+  def testErrors(self):
+    # Operations failing at once each report their own fatal() message
+    def fail(n):
+      time.sleep(0.01 * (n % 3))
+      self.c.fatal("Failure %d" % n)
+    futures = [ self.client.submit(fail,n) for n in range(12) ]
+    assert [ str(f.exception()) for f in futures ] == [ "Failure %d" % n for n in range(12) ]
+
+  def testAsCompleted(self):
+    def sleep(seconds):
+      time.sleep(seconds)
+      return seconds
+    futures = [ self.client.submit(sleep,s) for s in (0.3,0.1,0.2) ]
+    done = [ f.result() for f in asyncclient.as_completed(futures) ]
+    assert done == [0.1,0.2,0.3]
+    called = []
+    futures[0].add_done_callback(called.append)
+    assert called == [futures[0]]
+
+def suite():
+
+  suite = unittest.makeSuite(TestUnit,'test')
+
+  # If we want to add test methods one at a time, then we build up the
+  # test suite by hand.
+  #suite = unittest.TestSuite()
+  #suite.addTest(TestUnit("testOperations"))
+  #suite.addTest(TestUnit("testOptions"))
+  #suite.addTest(TestUnit("testErrors"))
+  #suite.addTest(TestUnit("testAsCompleted"))
+
+  return suite
+
+if __name__ == "__main__":
+  unittest.main(defaultTest="suite")
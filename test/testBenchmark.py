@@ -0,0 +1,210 @@
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+if os.path.exists("./jiraclient/"):
+  sys.path.insert(0,"./jiraclient/")
+
+import jiraclient
+import worklogs
+import fakejira
+import benchJira
+
+# How many requests workloads may make of the stand-in Jira server, so that
+# changes which make more are noticed.  See test/benchJira.py for timings.
+
+class TestUnit(unittest.TestCase):
+
+  def setUp(self):
+    self.jira = fakejira.FakeJira().start()
+    self.home = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.jira.stop()
+    shutil.rmtree(self.home)
+
+  def run_command(self,command,*args):
+    self.jira.reset_counts()
+    sys.argv = [command] + list(args) + self.jira.client_args(self.home)
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      if command == 'worklogs':
+        worklogs.WorklogReport().run()
+      else:
+        jiraclient.Jiraclient().run()
+    finally:
+      self.output = sys.stdout.getvalue()
+      sys.stdout = stdout
+    return self.jira.requests
+
+  def client(self,*args):
+    # A Jiraclient for library calls, with its session
+    sys.argv = ['jiraclient'] + list(args) + self.jira.client_args(self.home)
+    c = jiraclient.Jiraclient()
+    c.setup()
+    self.jira.reset_counts()
+    return c
+
+  def testCreate(self):
+    # Session, metadata and server info, then the issue
+    assert self.run_command('jiraclient','-T','task','-S','One') == 9
+    # All of that is remembered, only the issue is left
+    assert self.run_command('jiraclient','-T','task','-S','Two') == 1
+
+  def testExpiredSession(self):
+    # A session that expired early is made again and the request retried,
+    # even when only one request may be made at a time
+    self.run_command('jiraclient','-T','task','-S','One')
+    self.jira.expire_sessions()
+    thread = threading.Thread(target=self.run_command,args=('jiraclient','-T','task','-S','Two','--max-connections','1'))
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+    # The refused request, a new session, then the request again
+    assert self.jira.requests == 3
+    assert self.jira.counts['POST /rest/api/latest/issue'] == 2
+    assert len(self.jira.order) == 2
+
+  def testTemplate(self):
+    path = os.path.join(self.home,'template.yaml')
+    benchJira.template(path,stories=10,subtasks=4)
+    requests = self.run_command('jiraclient','--template',path)
+    # Metadata, the epic and its epic/theme, the stories in one bulk
+    # request, then all 40 subtasks in another, and the epic link
+    assert len(self.jira.order) == 51
+    assert self.jira.counts['POST /rest/api/latest/issue/bulk'] == 2
+    assert requests == 8 + 2 + 2 + 1
+
+  def testTemplateEpics(self):
+    # One epic per YAML document or NDJSON line.  Metadata the first time,
+    # then for each epic: the epic and its epic/theme, its stories, their
+    # subtasks and the epic link.
+    for (name,expected) in (('epics.yaml',8 + 3 * 5),('epics.ndjson',3 * 5)):
+      path = os.path.join(self.home,name)
+      benchJira.template(path,stories=2,subtasks=1,epics=3)
+      (issues,epics) = (len(self.jira.order),len(self.jira.epics))
+      requests = self.run_command('jiraclient','--template',path)
+      assert len(self.jira.order) - issues == 3 * 5
+      assert len(self.jira.epics) - epics == 3
+      assert requests == expected
+    # issues_created has the issues of every epic
+    c = self.client('--template',path)
+    c.create_issues_from_template()
+    assert len(c.issues_created) == 3 * 5
+    assert [ i['summary'] for i in c.issues_created if i['issuetype']['id'] == '6' ] == [ "Benchmark epic %d" % e for e in range(3) ]
+
+  def testSearch(self):
+    self.jira.add_issues(250)
+    assert self.run_command('jiraclient','--jql','project = INFOSYS') == 1 + 3
+    # Later pages are decoded an issue at a time, every issue is there
+    keys = [ issue['key'] for issue in self.client().search('project = INFOSYS') ]
+    assert keys == [ "INFOSYS-%d" % n for n in range(1,251) ]
+
+  def testWorklogs(self):
+    self.jira.add_issues(20,worklogs=3)
+    assert self.run_command('worklogs','--jql','project = INFOSYS') == 1 + 1 + 20
+    # Key, author and comment, and with --worklog-times when and how long
+    lines = self.output.splitlines()
+    assert len(lines) == 60
+    assert lines[0] == 'INFOSYS-1 jirauser Work 0 on INFOSYS-1'
+    self.run_command('worklogs','-i','INFOSYS-1','--worklog-times')
+    assert self.output.splitlines()[0] == 'INFOSYS-1 jirauser 2020-01-01T09:00:00.000+0000 3600 Work 0 on INFOSYS-1'
+    # An issue that's gone is skipped, the others are reported
+    self.run_command('worklogs','-i','INFOSYS-1,INFOSYS-9999,INFOSYS-2')
+    assert [ line.split()[0] for line in self.output.splitlines() ] == ['INFOSYS-1'] * 3 + ['INFOSYS-2'] * 3
+
+  def testTransitions(self):
+    # Transitions are fetched once per project, type and status
+    keys = self.jira.add_issues(150) + self.jira.add_issues(50,issuetype='7')
+    path = os.path.join(self.home,'keys')
+    fd = open(path,'w')
+    fd.write("\n".join(keys[:120] + ['INFOSYS-9999']) + "\n")
+    fd.close()
+    self.assertRaises(SystemExit,self.run_command,'jiraclient','--transition','Resolve Issue','--resolve','fixed','--keys',path)
+    assert self.jira.counts['GET /rest/api/latest/search'] == 2
+    assert self.jira.counts['GET /rest/api/latest/issue/{key}/transitions'] == 1
+    assert self.jira.counts['POST /rest/api/latest/issue/{key}/transitions'] == 120
+    assert self.jira.issues[keys[0]]['fields']['resolution'] == {'name': 'Fixed'}
+    # Then by status name, the resolved tasks have no way there
+    self.assertRaises(SystemExit,self.run_command,'jiraclient','--transition','resolved','--jql','project = INFOSYS')
+    assert self.jira.counts['GET /rest/api/latest/issue/{key}/transitions'] == 3
+    assert self.jira.counts['POST /rest/api/latest/issue/{key}/transitions'] == 80
+    assert len([ i for i in self.jira.issues.values() if i['fields']['status']['name'] == 'Resolved' ]) == 200
+
+  def testRefused(self):
+    # A 403 isn't an expired session, it's an error like a 404, and either
+    # is returned to callers that accept it
+    keys = self.jira.add_issues(1)
+    self.jira.refused = {keys[0]: 403}
+    c = self.client()
+    for (key,message) in ((keys[0],'Refused with 403'),('INFOSYS-9999','Issue Does Not Exist')):
+      try:
+        c.add_comment(key,'Refused')
+      except SystemExit, details:
+        assert message in details.msg
+      else:
+        self.fail("exit status 0")
+    assert os.path.exists(os.path.join(self.home,'session'))
+    uri = 'rest/api/latest/issue/%s/comment'
+    result = c.call_api('post',uri % keys[0],payload='{"body": "Refused"}',accept=(403,))
+    assert result == {'errorMessages': ['Refused with 403']}
+    result = c.call_api('post',uri % 'INFOSYS-9999',payload='{"body": "Refused"}',accept=(404,))
+    assert result == {'errorMessages': ['Issue Does Not Exist']}
+    assert self.jira.counts['POST /rest/api/latest/issue/{key}/comment'] == 4
+
+  def testTransitionsNoIssues(self):
+    # Which issues must be said
+    try:
+      self.run_command('jiraclient','--transition','Resolve Issue')
+    except SystemExit, details:
+      assert 'Please specify the issues' in details.msg
+    else:
+      self.fail("exit status 0")
+    assert self.jira.counts.get('POST /rest/api/latest/issue/{key}/transitions') is None
+
+  def testTransitionsRefused(self):
+    # Issues Jira won't transition are reported, the rest are made
+    keys = self.jira.add_issues(3)
+    self.jira.refused = {keys[0]: 403, keys[1]: 404}
+    try:
+      self.run_command('jiraclient','--transition','Resolve Issue','-i',','.join(keys))
+    except SystemExit, details:
+      assert details.code == 1
+    else:
+      self.fail("exit status 0")
+    results = [ jiraclient.json.loads(line) for line in self.output.splitlines() ]
+    assert [ r['ok'] for r in results ] == [False,False,True]
+    assert results[0]['error'] == ['Refused with 403']
+    assert results[1]['error'] == ['Refused with 404']
+    # Being refused didn't end our session
+    assert os.path.exists(os.path.join(self.home,'session'))
+
+def suite():
+
+  suite = unittest.makeSuite(TestUnit,'test')
+
+  # If we want to add test methods one at a time, then we build up the
+  # test suite by hand.
+  #suite = unittest.TestSuite()
+  #suite.addTest(TestUnit("testCreate"))
+  #suite.addTest(TestUnit("testExpiredSession"))
+  #suite.addTest(TestUnit("testTemplate"))
+  #suite.addTest(TestUnit("testTemplateEpics"))
+  #suite.addTest(TestUnit("testSearch"))
+  #suite.addTest(TestUnit("testWorklogs"))
+  #suite.addTest(TestUnit("testTransitions"))
+  #suite.addTest(TestUnit("testRefused"))
+  #suite.addTest(TestUnit("testTransitionsNoIssues"))
+  #suite.addTest(TestUnit("testTransitionsRefused"))
+
+  return suite
+
+if __name__ == "__main__":
+  unittest.main(defaultTest="suite")
@@ -34,25 +34,36 @@ class TestUnit(unittest.TestCase):
     issue = self.c.update_issue_obj(issue,'assignee','jirauser')
     issue = self.c.update_issue_obj(issue,'summary','summary')
 
+  def testIssueFields(self):
+    issue = jiraclient.Issue(summary='summary')
+    assert issue.parent == {'key': None}
+    issue.parent['key'] = 'INFOSYS-1'
+    assert jiraclient.Issue().parent == {'key': None}
+    issue.labels = issue.labels + ['change']
+    issue.customfield_10010 = ['INFOSYS-100']
+    issue.description = ''
+    issue.versions = [{'id': None}]
+    desired = {
+      'summary': 'summary',
+      'labels': ['change'],
+      'customfield_10010': ['INFOSYS-100'],
+    }
+    assert issue.fields() == desired
+    assert self.c.clean_issue(issue) == desired
+    assert repr(issue).startswith("Issue(customfield_10010=['INFOSYS-100'],description='',")
+    assert not hasattr(issue,'customfield_10011')
+    other = issue.copy()
+    other.customfield_10010.append('INFOSYS-101')
+    other.summary = 'other'
+    assert issue.fields() == desired
+
   def testCreateSimpleIssue(self):
     self.c.options.project = "INFOSYS"
     issue = self.c.create_issue_obj('task')
-    got = issue.__dict__
+    got = issue.fields()
     desired = {
-      'assignee': {'name': None},
-      'components': [{'id': None}],
-      'description': '',
-      'duedate': '',
-      'environment': '',
-      'fixVersions': [{'id': None}],
       'issuetype': {'id': '3'},
-      'labels': [],
-      'priority': {'id': None},
       'project': {'id': '00'},
-      'parent': {'key': None},
-      'summary': '',
-      'timetracking': {'originalEstimate': None},
-      'versions': [{'id': None}],
     }
     diff = DictDiffer(got,desired)
     assert diff.areEqual()
@@ -76,7 +87,7 @@ class TestUnit(unittest.TestCase):
     self.c.options.epic_theme = 'INFOSYS-100'
 
     issue = self.c.create_issue_obj('task')
-    got = issue.__dict__
+    got = issue.fields()
     desired = {
       'assignee': {'name': 'jirauser'},
       'components': [{'id': '10111'}],
@@ -89,14 +100,54 @@ class TestUnit(unittest.TestCase):
       'priority': {'id': '4'},
       'project': {'id': '10001'},
       'summary': 'summary',
-      'parent': {'key': None},
-      'timetracking': {'originalEstimate': None},
       'versions': [{'id': '10080'}],
       'customfield_10010': ['INFOSYS-100'],
     }
     diff = DictDiffer(got,desired)
     assert diff.areEqual()
 
+  def testCreateIssuesBulk(self):
+    self.c.options.project = "INFOSYS"
+    self.c.options.noop = False
+    self.c.options.bulk_size = '2'
+    requests = []
+    def call_api(method,uri,payload=None,full=False,accept=()):
+      requests.append((method,uri))
+      if len(requests) == 1:
+        return {'issues': [{'key': 'INFOSYS-1'}],
+                'errors': [{'status': 400, 'failedElementNumber': 0,
+                            'elementErrors': {'errors': {'summary': 'required'}}}]}
+      return {'issues': [{'key': 'INFOSYS-2'}], 'errors': []}
+    self.c.call_api = call_api
+    self.c.get_serverinfo = lambda: {'baseUrl': 'https://jira'}
+    issues = []
+    for summary in ('', 'two', 'three'):
+      issue = jiraclient.Issue()
+      issue.summary = summary
+      issues.append(issue)
+    keys = self.c.create_issues(issues)
+    assert keys == [None, 'INFOSYS-1', 'INFOSYS-2']
+    assert requests == [('post','rest/api/latest/issue/bulk')] * 2
+    assert [ i['summary'] for i in self.c.issues_created ] == ['two', 'three']
+
+  def testCreateIssuesBulkErrors(self):
+    # Errors that aren't the bulk API's list fail the issues without a key
+    self.c.options.project = "INFOSYS"
+    self.c.options.noop = False
+    self.c.get_serverinfo = lambda: {'baseUrl': 'https://jira'}
+    issues = []
+    for summary in ('one', 'two'):
+      issue = jiraclient.Issue()
+      issue.summary = summary
+      issues.append(issue)
+    for result in ({'errorMessages': [], 'errors': {'project': 'project is required'}},
+                   {'errors': 'Internal error'},
+                   {'errors': [None, {'status': 400}]}):
+      self.c.call_api = lambda method,uri,payload=None,full=False,accept=(): result
+      assert self.c.create_issues_bulk(issues) == [None, None]
+    self.c.call_api = lambda method,uri,payload=None,full=False,accept=(): {'issues': [{'key': 'INFOSYS-1'}], 'errors': {}}
+    assert self.c.create_issues_bulk(issues) == ['INFOSYS-1', None]
+
 def suite():
 
   suite = unittest.makeSuite(TestUnit,'test')
@@ -105,8 +156,11 @@ def suite():
   # test suite by hand.
   #suite = unittest.TestSuite()
   #suite.addTest(TestUnit("testUpdateIssueObj"))
+  #suite.addTest(TestUnit("testIssueFields"))
   #suite.addTest(TestUnit("testCreateSimpleIssue"))
   #suite.addTest(TestUnit("testCreateIssueObj"))
+  #suite.addTest(TestUnit("testCreateIssuesBulk"))
+  #suite.addTest(TestUnit("testCreateIssuesBulkErrors"))
 
   return suite
 
@@ -5,6 +5,10 @@ import os
 import unittest
 #import json
 import base64
+import pickle
+import shutil
+import StringIO
+import tempfile
 from DictDiffer import DictDiffer
 
 if os.path.exists("./jiraclient/"):
@@ -46,6 +50,30 @@ class TestUnit(unittest.TestCase):
     assert jiraclient.time_is_valid('1q') is False
     assert jiraclient.time_is_valid('0.1m') is False
 
+  def testSearchableDict(self):
+    d = jiraclient.SearchableDict({'1': 'backlog', '2': {'name': 'it service', 'values': []}})
+    d['3'] = 'Backlog'
+    assert d.find_key('BACKLOG') in ('1','3')
+    assert d.find_key('it service') == '2'
+    assert d.find_key('nothing') is None
+    del d['1']
+    assert d.find_key('backlog') == '3'
+    d['3'] = 'ideas'
+    assert d.find_key('backlog') is None
+    assert d.find_key('ideas') == '3'
+    assert d.copy().find_key('ideas') == '3'
+    assert pickle.loads(pickle.dumps(d,2)).find_key('it service') == '2'
+
+  def testJSONStream(self):
+    doc = '{"expand": "names", "startAt": 0, "total": 3, "issues": [ {"key": "A-1", "n": 12345}, {"key": "A-2", "s": "\\u00e9"}, 67890 ], "after": 1}'
+    for chunksize in (1,3,1000):
+      items = list(jiraclient.JSONStream(StringIO.StringIO(doc),chunksize).items('issues'))
+      assert items == [{'key': 'A-1', 'n': 12345}, {'key': 'A-2', 's': u'\u00e9'}, 67890]
+      items = list(jiraclient.JSONStream(StringIO.StringIO(' [1, [2], {}] '),chunksize).items())
+      assert items == [1, [2], {}]
+    assert list(jiraclient.JSONStream(StringIO.StringIO('{"total": 0}')).items('issues')) == []
+    self.assertRaises(ValueError,list,jiraclient.JSONStream(StringIO.StringIO('[1, 2')).items())
+
   def testFatal(self):
     self.assertRaises(SystemExit,self.c.fatal)
 
@@ -82,6 +110,43 @@ class TestUnit(unittest.TestCase):
 
     self.setUp()
 
+  def testMetadataCache(self):
+    self.c.options.metadata_cache = tempfile.mkdtemp()
+    try:
+      self.c.options.project = 'INFOSYS'
+      self.c.maps['project']['10001'] = 'infosys'
+      self.c.maps['issuetype']['7'] = 'story'
+      self.c.maps['versions']['10020'] = 'backlog'
+      self.c.maps['customfields']['7'] = jiraclient.SearchableDict()
+      self.c.maps['customfields']['7']['customfield_10010'] = 'epic/theme'
+      self.c.save_metadata_cache()
+
+      c = jiraclient.Jiraclient()
+      c.options = self.c.options
+      c.logger = self.c.logger
+      assert c.load_metadata_cache()
+      assert c.maps_source == 'cache'
+      assert c.maps['project'].find_key('infosys') == '10001'
+      assert c.maps['fixversions'].find_key('backlog') == '10020'
+      assert c.maps['customfields']['7'].find_key('epic/theme') == 'customfield_10010'
+
+      # Expired or explicitly refreshed caches are not used
+      c.options.metadata_ttl = '0'
+      assert not c.load_metadata_cache()
+      c.options.metadata_ttl = None
+      c.options.refresh_metadata = True
+      assert not c.load_metadata_cache()
+    finally:
+      shutil.rmtree(self.c.options.metadata_cache)
+
+  def testServerVersion(self):
+    self.c.serverinfo = {'baseUrl': 'https://jira', 'version': '6.4.3'}
+    assert self.c.server_version == (6,4,3)
+    assert self.c.supports_bulk_create()
+    self.c.serverinfo = {'baseUrl': 'https://jira', 'versionNumbers': [5,2,11]}
+    assert self.c.server_version == (5,2,11)
+    assert not self.c.supports_bulk_create()
+
   def testGetIssueTypes(self):
     self.c.get_issue_types('INFOSYS')
     pp.pprint(self.c.maps['issuetype'])
@@ -97,15 +162,17 @@ class TestUnit(unittest.TestCase):
     self.c.get_issue_types('INFOSYS')
     assert self.c.maps['issuetype']['6'] == 'epic'
     self.c.get_customfields('INFOSYS','6')
-    desired = { '6': {
+    desired = {
             'customfield_10010': 'epic/theme',
             'customfield_10002': 'story points',
             'customfield_10003': 'business value',
             'customfield_10000': 'flagged',
             'customfield_10441': 'epic name',
             'customfield_10440': 'epic link'
-            }}
-    diff = DictDiffer(self.c.maps['customfields'],desired)
+            }
+    # get_issue_types() fetched the custom fields of every issue type
+    assert set(self.c.maps['customfields'].keys()) == set(self.c.maps['issuetype'].keys())
+    diff = DictDiffer(self.c.maps['customfields']['6'],desired)
     assert diff.areEqual()
 
   def testGetResolutions(self):
@@ -138,22 +205,16 @@ class TestUnit(unittest.TestCase):
     self.c.get_priorities()
     i = self.c.create_issue_obj('story',defaults=True)
     desired = {
-     'environment': '',
-     'duedate': '',
-     'labels': [],
      'assignee': {'name':'jirauser'},
      'components': [{'id': '10111'}],
-     'versions': [{'id': None}],
-     'parent': {'key':None},
      'description': 'Description',
      'fixVersions': [{'id': '10033'}],
      'priority': {'id':'6'},
      'project': {'id':'10001'},
-     'timetracking': {'originalEstimate':None},
      'summary': 'Summary',
      'issuetype': {'id':'7'}
     }
-    diff = DictDiffer(i.__dict__,desired)
+    diff = DictDiffer(i.fields(),desired)
     assert diff.areEqual()
 
   def testGetIssue(self):
@@ -162,6 +223,192 @@ class TestUnit(unittest.TestCase):
     assert i['key'] == 'INFOSYS-1'
     assert i['fields']['project']['key'] == 'INFOSYS'
 
+  def testIssueUri(self):
+    assert self.c.issue_uri('INFOSYS-1') == 'rest/api/latest/issue/INFOSYS-1'
+    uri = self.c.issue_uri('INFOSYS-1',fields=['summary','status'],expand='changelog')
+    assert uri == 'rest/api/latest/issue/INFOSYS-1?fields=summary%2Cstatus&expand=changelog'
+
+  def testBatch(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      batchfile = os.path.join(tmpdir,'batch')
+      fd = open(batchfile,'w')
+      fd.write('# comment\n')
+      fd.write('-n -P INFOSYS -T task -S "Batch task"\n')
+      fd.write('\n')
+      fd.write('{"id": "two", "noop": true, "project": "INFOSYS", "issuetype": "task", "summary": "JSON task"}\n')
+      fd.write('--no-such-option\n')
+      fd.close()
+      self.c.options.batch = batchfile
+      self.c.options.jiraurl = 'http://localhost'
+      stdout = sys.stdout
+      sys.stdout = StringIO.StringIO()
+      try:
+        try:
+          self.c.run_batch()
+        except SystemExit, details:
+          assert details.code == 1
+          assert details.msg == "1 of 3 batch operations failed"
+        else:
+          self.fail("no SystemExit")
+        lines = sys.stdout.getvalue().splitlines()
+      finally:
+        sys.stdout = stdout
+      results = [ jiraclient.json.loads(line) for line in lines ]
+      assert [ r['line'] for r in results ] == [2,4,5]
+      assert results[0]['ok'] and results[0]['result'] == 'NOOP'
+      assert results[1]['id'] == 'two' and results[1]['result'] == 'NOOP'
+      assert not results[2]['ok'] and 'no-such-option' in results[2]['error']
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def testServeRequest(self):
+    self.c.options.noop = True
+    self.c.options.jiraurl = 'http://localhost'
+    request = {'cwd': os.getcwd(), 'jiraurl': 'http://localhost', 'user': 'jirauser', 'args': [],
+      'options': {'project': 'INFOSYS', 'issuetype': 'task', 'summary': 'From a client', 'loglevel': 'INFO'}}
+    wfile = StringIO.StringIO()
+    self.c.serve_request(StringIO.StringIO(jiraclient.json.dumps(request) + "\n"),wfile)
+    messages = [ jiraclient.json.loads(line) for line in wfile.getvalue().splitlines() ]
+    assert messages[-1] == {'exit': 0}
+    assert [ m for m in messages if 'Created' in m.get('err','') ]
+    assert self.c.logger.level == jiraclient.logging.DEBUG
+
+    request['user'] = 'someone'
+    wfile = StringIO.StringIO()
+    self.c.serve_request(StringIO.StringIO(jiraclient.json.dumps(request) + "\n"),wfile)
+    assert 'refused' in jiraclient.json.loads(wfile.getvalue())
+
+  def testForward(self):
+    # Runs that read our stdin, or report --stats, aren't forwarded
+    import socket
+    home = tempfile.mkdtemp()
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+      path = os.path.join(home,'socket')
+      sock.bind(path)
+      sock.listen(1)
+      self.c.options.socket = path
+      for (name,value) in (('batch','-'),('keys','-'),('template','-'),('stats',True),('stats_file','stats')):
+        default = getattr(self.c.options,name)
+        setattr(self.c.options,name,value)
+        assert self.c.forward({}) is False
+        setattr(self.c.options,name,default)
+      # The daemon never heard from us
+      sock.setblocking(0)
+      self.assertRaises(socket.error,sock.accept)
+    finally:
+      sock.close()
+      shutil.rmtree(home)
+
+  def testProjectMaps(self):
+    # Each project gets its own maps, fetched once, priorities are shared
+    requests = []
+    def call_api(method,uri,payload=None,full=False,accept=()):
+      requests.append(uri)
+      key = uri.split('projectKeys=')[-1].split('&')[0]
+      if uri.startswith('rest/api/latest/project/'):
+        key = uri.split('/')[4]
+        if uri.endswith('versions') or uri.endswith('components'):
+          return [{'id': '1%s' % len(key), 'name': '%s thing' % key}]
+        return {'id': str(len(key)), 'key': key}
+      if 'createmeta' in uri:
+        return {'projects': [{'issuetypes': [{'id': '3', 'name': 'Task', 'fields': {}}]}]}
+      if uri.endswith('transitions'):
+        return {'transitions': [{'id': '21', 'name': 'Resolve Issue', 'to': {'id': '5', 'name': 'Resolved'}}]}
+      return [{'id': '6', 'name': 'Normal'}]
+    self.c.call_api = call_api
+    self.c.options.metadata_cache = None
+    self.c.project_maps.size = 2
+    for project in ('ABC','DEFG','ABC','HI','DEFG'):
+      self.c.options.project = project
+      self.c.update_maps_from_jiraserver()
+      assert self.c.maps['project'].find_key(project) == str(len(project))
+      assert self.c.maps['components'].find_key('%s thing' % project) == '1%s' % len(project)
+    # DEFG was forgotten to make room for HI
+    assert len([ uri for uri in requests if uri == 'rest/api/latest/project/DEFG' ]) == 2
+    assert len([ uri for uri in requests if uri == 'rest/api/latest/project/ABC' ]) == 1
+    assert len([ uri for uri in requests if uri == 'rest/api/latest/priority' ]) == 1
+    assert self.c.project_maps.get('hi')[0]['priority'] is self.c.maps['priority']
+
+    transitions = self.c.get_transitions('ABC-1','3','1')
+    assert self.c.find_transition(transitions,'resolved') == '21'
+    assert self.c.find_transition(transitions,'resolve issue') == '21'
+    assert self.c.get_transitions('ABC-2','3','1') is transitions
+    assert self.c.get_transitions('HI-2','3','1') is not transitions
+    assert len([ uri for uri in requests if uri.endswith('transitions') ]) == 2
+
+  def testProjectGetters(self):
+    # The get_*() methods fill the maps of the project they're given
+    requests = []
+    def call_api(method,uri,payload=None,full=False,accept=()):
+      requests.append(uri)
+      key = uri.split('/')[4]
+      if uri.endswith('versions'):
+        return [{'id': '2%s' % len(key), 'name': '%s version' % key}]
+      if uri.endswith('components'):
+        return [{'id': '3%s' % len(key), 'name': '%s comp' % key}]
+      return {'id': str(len(key)), 'key': key}
+    self.c.call_api = call_api
+    for project in ('ABC','DEFGH','ABC','DEFGH'):
+      self.c.get_project_id(project)
+      self.c.get_project_versions(project)
+      self.c.get_project_components(project)
+      assert self.c.maps['project'].items() == [(str(len(project)),project.lower())]
+      assert self.c.maps['versions'].items() == [('2%s' % len(project),'%s version' % project.lower())]
+      assert self.c.maps['components'].items() == [('3%s' % len(project),'%s comp' % project.lower())]
+    # Each project's were fetched once
+    assert len(requests) == 6
+
+  def testRetryDelay(self):
+    class Response(object):
+      def __init__(self,headers):
+        self.headers = headers
+    class Error(Exception):
+      def __init__(self,status_int,headers={}):
+        self.status_int = status_int
+        self.response = Response(headers)
+    self.c.options.retries = '2'
+    self.c.options.retry_backoff = '1'
+    assert self.c.retry_delay('get',Error(429,{'Retry-After':'7'}),0) == 7
+    assert self.c.retry_delay('post',Error(503,{'retry-after':'3'}),1) == 3
+    assert self.c.retry_delay('get',Error(503),2) is None
+    assert 1 <= self.c.retry_delay('put',Error(502),1) <= 2
+    assert self.c.retry_delay('post',Error(502),0) is None
+    assert self.c.retry_delay('post',IOError(),0) is None
+    assert self.c.retry_delay('get',Error(400),0) is None
+    # Nothing listening, or no such host
+    assert self.c.retry_delay('get',IOError('socket.error: [Errno 111] Connection refused'),0) is None
+    assert self.c.retry_delay('get',IOError('[Errno -2] Name or service not known'),0) is None
+    assert 1 <= self.c.retry_delay('get',IOError('socket.error: [Errno 104] Connection reset by peer'),1) <= 2
+    headers = {'X-RateLimit-Remaining':'0','X-RateLimit-FillRate':'5','X-RateLimit-Interval-Seconds':'1'}
+    assert self.c.retry_delay('get',Error(429,headers),0) == 0.2
+
+    limiter = jiraclient.Limiter(4)
+    limiter.overloaded()
+    limiter.overloaded()
+    assert limiter.limit == 1
+    for n in range(3):
+      limiter.succeeded()
+    assert limiter.limit == 3
+
+  def testRequestStats(self):
+    stats = jiraclient.RequestStats()
+    assert stats.endpoint('rest/api/latest/issue/INFOSYS-5305/worklog?startAt=0') == 'rest/api/latest/issue/{key}/worklog'
+    assert stats.endpoint('rest/api/latest/project/INFOSYS/versions') == 'rest/api/latest/project/{project}/versions'
+    assert stats.endpoint('rest/api/latest/issueLink/10042') == 'rest/api/latest/issueLink/{id}'
+    stats.record('GET','rest/api/latest/issue/INFOSYS-1',0.2,0,100)
+    stats.record('get','rest/api/latest/issue/INFOSYS-2',3,0,0,error=True,retried=True)
+    data = stats.endpoints[('get','rest/api/latest/issue/{key}')]
+    assert (data['count'],data['errors'],data['retries'],data['received']) == (2,1,1,100)
+    assert data['buckets'][stats.buckets.index(0.25)] == 1
+    connections = {'connections': 1, 'reused': 1, 'requests': 2}
+    report = stats.report('prometheus',connections)
+    assert 'jiraclient_request_duration_seconds_bucket{method="get",endpoint="rest/api/latest/issue/{key}",le="0.25"} 1' in report
+    assert 'jiraclient_request_duration_seconds_bucket{method="get",endpoint="rest/api/latest/issue/{key}",le="5"} 2' in report
+    assert 'jiraclient_connections_reused_total 1' in report
+    assert jiraclient.json.loads(stats.report('json',connections))['endpoints'][0]['count'] == 2
+
   def testGetIssueLinks(self):
     self.c.get_priorities()
     data = self.c.get_issue_links('INFOSYS-5305')
@@ -177,11 +424,15 @@ def suite():
   #suite = unittest.TestSuite()
   #suite.addTest(TestUnit("testLogger"))
   #suite.addTest(TestUnit("testTimeIsValid"))
+  #suite.addTest(TestUnit("testSearchableDict"))
+  #suite.addTest(TestUnit("testJSONStream"))
   #suite.addTest(TestUnit("testFatal"))
   #suite.addTest(TestUnit("testReadConfig"))
   #suite.addTest(TestUnit("testGetProjectId"))
   #suite.addTest(TestUnit("testGetSession"))
   #suite.addTest(TestUnit("testCheckAuth"))
+  #suite.addTest(TestUnit("testMetadataCache"))
+  #suite.addTest(TestUnit("testServerVersion"))
   #suite.addTest(TestUnit("testGetIssue"))
   #suite.addTest(TestUnit("testGetIssueTypes"))
   #suite.addTest(TestUnit("testGetCustomFields"))
@@ -191,6 +442,14 @@ def suite():
   #suite.addTest(TestUnit("testGetProjectComponents"))
   #suite.addTest(TestUnit("testGetPriorities"))
   #suite.addTest(TestUnit("testCreateIssueObj"))
+  #suite.addTest(TestUnit("testIssueUri"))
+  #suite.addTest(TestUnit("testBatch"))
+  #suite.addTest(TestUnit("testServeRequest"))
+  #suite.addTest(TestUnit("testForward"))
+  #suite.addTest(TestUnit("testProjectMaps"))
+  #suite.addTest(TestUnit("testProjectGetters"))
+  #suite.addTest(TestUnit("testRetryDelay"))
+  #suite.addTest(TestUnit("testRequestStats"))
 
   return suite
 
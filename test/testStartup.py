@@ -0,0 +1,63 @@
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+script = "./jiraclient/jiraclient.py"
+
+# Modules that only some commands need, which must not slow the others
+heavy = ('restkit','socketpool','multiprocessing','urllib','socket','SocketServer')
+
+def python(*args):
+  # Run a new interpreter, like a shell or wrapper script would
+  env = dict(os.environ)
+  env.setdefault("USER","jirauser")
+  proc = subprocess.Popen([sys.executable] + list(args),env=env,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+  (out,err) = proc.communicate()
+  assert proc.returncode == 0, err
+  return out
+
+class TestUnit(unittest.TestCase):
+
+  def testImport(self):
+    out = python("-c","import sys; sys.path.insert(0,'./jiraclient/'); import jiraclient; print ' '.join(sys.modules)")
+    loaded = [ m for m in out.split() if m.split('.')[0] in heavy ]
+    assert loaded == [], loaded
+
+  def testNoopImports(self):
+    # A noop run neither authenticates nor connects to Jira
+    code = "import sys; sys.path.insert(0,'./jiraclient/'); import jiraclient; " \
+      "sys.argv = ['jiraclient','-n','--config','./test/data/jiraclientrc-001','--sessionfile','/nonexistent','--socket','','-P','INFOSYS','-T','task','-S','Startup']; " \
+      "jiraclient.Jiraclient().run(); print ' '.join(sys.modules)"
+    out = python("-c",code)
+    loaded = [ m for m in out.split() if m.split('.')[0] in heavy ]
+    assert loaded == [], loaded
+
+  def testVersionTime(self):
+    # Not a strict limit, the time is printed to keep an eye on it
+    runs = 5
+    start = time.time()
+    for n in range(runs):
+      out = python(script,"--version")
+    elapsed = (time.time() - start) / runs
+    sys.stderr.write("jiraclient --version: %.0f ms " % (elapsed * 1000))
+    assert out.startswith("jiraclient version")
+    assert elapsed < 2
+
+def suite():
+
+  suite = unittest.makeSuite(TestUnit,'test')
+
+  # If we want to add test methods one at a time, then we build up the
+  # test suite by hand.
+  #suite = unittest.TestSuite()
+  #suite.addTest(TestUnit("testImport"))
+  #suite.addTest(TestUnit("testNoopImports"))
+  #suite.addTest(TestUnit("testVersionTime"))
+
+  return suite
+
+if __name__ == "__main__":
+  unittest.main(defaultTest="suite")